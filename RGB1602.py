@@ -19,6 +19,16 @@ REG_BLUE   =     0x02
 REG_MODE1  =     0x00
 REG_MODE2  =     0x01
 REG_OUTPUT =     0x08
+REG_GRPPWM =     0x06
+REG_GRPFREQ =    0x07
+#control register flag: auto-increment the register address after each byte
+REG_AUTO_INC =   0x80
+
+#MODE2 flag: group control is blinking (set) or dimming (clear)
+MODE2_DMBLNK =   0x20
+#OUTPUT values: LEDs driven by their own PWM only, or by PWM and GRPPWM
+OUTPUT_PWM =     0xAA
+OUTPUT_GROUP =   0xFF
 LCD_CLEARDISPLAY = 0x01
 LCD_RETURNHOME = 0x02
 LCD_ENTRYMODESET = 0x04
@@ -48,6 +58,10 @@ LCD_CURSORMOVE = 0x00
 LCD_MOVERIGHT = 0x04
 LCD_MOVELEFT = 0x00
 
+#unchanged cells tolerated inside one update() run before it is split in two
+#(a new run costs a setCursor transaction plus a data transaction header)
+LCD_RUN_MERGE_GAP = 4
+
 #flags for function set
 LCD_8BITMODE = 0x10
 LCD_4BITMODE = 0x00
@@ -57,45 +71,200 @@ LCD_5x8DOTS = 0x00
 
 
 class RGB1602:
-  def __init__(self, col, row):
+  # begin=False leaves the controller uninitialized so that the caller can
+  # run beginSteps() itself (see aiorgb1602)
+  def __init__(self, col, row, begin=True):
     self._row = row
     self._col = col
+    # shadow framebuffer: what the display currently shows, one byte per cell
+    self._fb = bytearray(b' ' * (col * row))
+    self._cursor = 0
+    # scratch buffers reused by every transfer, so that steady-state updates
+    # do not allocate: _runBufs[n] holds a run of n bytes (slicing would
+    # allocate a new memoryview per transfer), _regArgs the register values
+    # of setRGB and blinkLED
+    self._byteBuf = bytearray(1)
+    self._cursorBuf = bytearray(2)
+    self._runBufs = [bytearray(n) for n in range(max(col, REG_OUTPUT + 1) + 1)]
+    self._regArgs = bytearray(3)
+    # shadow copy of the backlight controller registers (MODE1..OUTPUT) and a
+    # bitmask of which entries are known to match the hardware
+    self._regs = bytearray(REG_OUTPUT + 1)
+    self._regsValid = 0
+    # I2C transactions and bytes (address and register included) sent by
+    # this driver, for diagnostics
+    self.i2cTransactions = 0
+    self.i2cBytes = 0
 
     self._showfunction = LCD_4BITMODE | LCD_1LINE | LCD_5x8DOTS;
-    self.begin(self._row,self._col)
+    if begin:
+      self.begin(self._row,self._col)
+
+
+  # Every transfer goes through these two so that the traffic is counted
+  def _writeMem(self,addr,reg,data):
+    RGB1602_I2C.writeto_mem(addr, reg, data)
+    self.i2cTransactions += 1
+    self.i2cBytes += len(data) + 2
+
+  def _writeTo(self,addr,data):
+    RGB1602_I2C.writeto(addr, data)
+    self.i2cTransactions += 1
+    self.i2cBytes += len(data) + 1
 
-        
   def command(self,cmd):
-    RGB1602_I2C.writeto_mem(LCD_ADDRESS, 0x80, chr(cmd))
+    self._byteBuf[0] = cmd
+    self._writeMem(LCD_ADDRESS, 0x80, self._byteBuf)
 
   def write(self,data):
-    RGB1602_I2C.writeto_mem(LCD_ADDRESS, 0x40, chr(data))
+    self._byteBuf[0] = data
+    self._writeMem(LCD_ADDRESS, 0x40, self._byteBuf)
     
   def setReg(self,reg,data):
-    RGB1602_I2C.writeto_mem(RGB_ADDRESS, reg, chr(data))
+    if (self._regsValid >> reg) & 1 and self._regs[reg] == data:
+      return
+    self._byteBuf[0] = data
+    self._writeMem(RGB_ADDRESS, reg, self._byteBuf)
+    self._regs[reg] = data
+    self._regsValid |= 1 << reg
 
+  # Write consecutive backlight registers starting at reg in one auto-increment
+  # transaction, trimmed to the span that differs from the shadow copy.
+  def setRegs(self,reg,values):
+    first = -1
+    last = -1
+    for i in range(len(values)):
+      r = reg + i
+      if not ((self._regsValid >> r) & 1 and self._regs[r] == values[i]):
+        if first < 0:
+          first = i
+        last = i
+    if first < 0:
+      return
+    buf = self._runBufs[last - first + 1]
+    for i in range(first, last + 1):
+      self._regs[reg + i] = values[i]
+      self._regsValid |= 1 << (reg + i)
+      buf[i - first] = values[i]
+    self._writeMem(RGB_ADDRESS, REG_AUTO_INC | (reg + first), buf)
 
   def setRGB(self,r,g,b):
-    self.setReg(REG_RED,r)
-    self.setReg(REG_GREEN,g)
-    self.setReg(REG_BLUE,b)
+    # BLUE, GREEN and RED are consecutive registers
+    args = self._regArgs
+    args[0] = b
+    args[1] = g
+    args[2] = r
+    self.setRegs(REG_BLUE,args)
+
+  # Blink the whole backlight in hardware using the controller's group PWM.
+  # period_ms ranges from ~42 ms to ~10.6 s, duty (0-255) is the lit share of
+  # the period. After this call the controller blinks on its own, so it costs
+  # no CPU time or I2C traffic until the pattern changes.
+  def blinkLED(self,period_ms=1000,duty=128):
+    freq = max(0, min(255, period_ms * 24 // 1000 - 1))
+    self.setReg(REG_MODE2, MODE2_DMBLNK)
+    args = self._regArgs
+    args[0] = max(0, min(255, duty))
+    args[1] = freq
+    args[2] = OUTPUT_GROUP
+    self.setRegs(REG_GRPPWM, args)
+
+  def noBlinkLED(self):
+    self.setReg(REG_OUTPUT, OUTPUT_PWM)
+
+  # Dim the whole backlight in hardware (0-255) without touching the colour.
+  # The controller has no ramp engine, so this is a step change; it replaces
+  # any blinking pattern.
+  def setBrightness(self,level):
+    self.setReg(REG_MODE2, 0)
+    self.setReg(REG_GRPPWM, max(0, min(255, level)))
+    self.setReg(REG_OUTPUT, OUTPUT_GROUP)
 
   def setCursor(self,col,row):
+    self._cursor = (0 if row == 0 else self._col) + col
     if(row == 0):
       col|=0x80
     else:
       col|=0xc0;
-    RGB1602_I2C.writeto(LCD_ADDRESS, bytearray([0x80,col]))
+    self._cursorBuf[0] = 0x80
+    self._cursorBuf[1] = col
+    self._writeTo(LCD_ADDRESS, self._cursorBuf)
 
   def clear(self):
     self.command(LCD_CLEARDISPLAY)
     time.sleep(0.002)
+    self.clearFramebuffer()
+
+  # Forget the shadow state after a failed transfer, so that the next
+  # update() and register writes resend everything
+  def invalidate(self):
+    for i in range(len(self._fb)):
+      self._fb[i] = 0
+    self._regsValid = 0
+
+  # Mark the shadow framebuffer blank after the controller has been cleared
+  def clearFramebuffer(self):
+    for i in range(len(self._fb)):
+      self._fb[i] = 0x20
+    self._cursor = 0
+
+  # arg may be an int, a str, or a bytes-like object which is sent as is
   def printout(self,arg):
     if(isinstance(arg,int)):
       arg=str(arg)
+    if(isinstance(arg,str)):
+      arg=arg.encode()
+
+    # one data transaction for the whole string
+    self._writeMem(LCD_ADDRESS, 0x40, arg)
+    # mirror into the framebuffer, up to the end of the current row
+    end = (self._cursor // self._col + 1) * self._col
+    n = min(len(arg), end - self._cursor)
+    for i in range(max(0, n)):
+      self._fb[self._cursor + i] = arg[i]
+    self._cursor += len(arg)
 
-    for x in bytearray(arg,'utf-8'):
-      self.write(x)
+  # Bring the display up to date with the given lines without clearing it.
+  # Each line is diffed against the shadow framebuffer and only the runs of
+  # changed cells are sent, each as one setCursor plus one multi-byte write.
+  # Lines may be str or bytes-like (e.g. a bytearray reused by the caller,
+  # which avoids allocating); only the first col characters are drawn.
+  def update(self,line1,line2=""):
+    self._updateRow(0, line1)
+    if self._row > 1:
+      self._updateRow(1, line2)
+
+  def _updateRow(self,row,text):
+    if(isinstance(text,str)):
+      text = text.encode()
+    fb = self._fb
+    base = row * self._col
+    n = len(text)
+    start = -1
+    last = -1
+    for i in range(self._col):
+      c = text[i] if i < n else 0x20
+      if fb[base + i] == c:
+        if start >= 0 and i - last > LCD_RUN_MERGE_GAP:
+          self._flushRun(row, start, last)
+          start = -1
+        continue
+      fb[base + i] = c
+      if start < 0:
+        start = i
+      last = i
+    if start >= 0:
+      self._flushRun(row, start, last)
+
+  def _flushRun(self,row,start,last):
+    self.setCursor(start, row)
+    base = row * self._col + start
+    fb = self._fb
+    buf = self._runBufs[last - start + 1]
+    for i in range(last - start + 1):
+      buf[i] = fb[base + i]
+    self._writeMem(LCD_ADDRESS, 0x40, buf)
+    self._cursor += last - start + 1
 
 
   def display(self):
@@ -104,6 +273,13 @@ class RGB1602:
 
  
   def begin(self,cols,lines):
+    for delay_ms in self.beginSteps(cols,lines):
+      time.sleep(delay_ms / 1000)
+
+  # Initialization sequence as a generator: it yields the delay in ms that the
+  # controller needs before the next step, so the same sequence can be run
+  # blocking (begin) or from a coroutine without stalling the event loop.
+  def beginSteps(self,cols,lines):
     if (lines > 1):
         self._showfunction |= LCD_2LINE 
      
@@ -112,17 +288,17 @@ class RGB1602:
 
     
      
-    time.sleep(0.05)
+    yield 50
 
 
     # Send function set command sequence
     self.command(LCD_FUNCTIONSET | self._showfunction)
     #delayMicroseconds(4500);  # wait more than 4.1ms
-    time.sleep(0.005)
+    yield 5
     # second try
     self.command(LCD_FUNCTIONSET | self._showfunction);
     #delayMicroseconds(150);
-    time.sleep(0.005)
+    yield 5
     # third go
     self.command(LCD_FUNCTIONSET | self._showfunction)
     # finally, set # lines, font size, etc.
@@ -131,7 +307,9 @@ class RGB1602:
     self._showcontrol = LCD_DISPLAYON | LCD_CURSOROFF | LCD_BLINKOFF 
     self.display()
     # clear it off
-    self.clear()
+    self.command(LCD_CLEARDISPLAY)
+    yield 2
+    self.clearFramebuffer()
     # Initialize to default text direction (for romance languages)
     self._showmode = LCD_ENTRYLEFT | LCD_ENTRYSHIFTDECREMENT 
     # set the entry mode
@@ -0,0 +1,83 @@
+# Burst oversampling and filtering for noisy ADC channels.
+#
+# BurstADC wraps a machine.ADC and can be used in its place: every read_u16()
+# takes a burst of raw readings into a preallocated buffer, reduces them to a
+# single value and optionally smooths the result with an exponential moving
+# average. All arithmetic is on small integers, so nothing is allocated per
+# sample.
+
+from micropython import const
+from array import array
+
+# Reducers
+REDUCE_MEAN = const(0)
+REDUCE_MEDIAN = const(1)
+# Mean of the burst after dropping the `trim` lowest and highest readings
+REDUCE_TRIMMED = const(2)
+
+
+class BurstADC:
+    # n: readings per burst
+    # ema_shift: EMA weight of a new value is 1 / 2**ema_shift, 0 disables
+    def __init__(self, adc, n=8, reducer=REDUCE_TRIMMED, trim=2, ema_shift=0):
+        if reducer == REDUCE_TRIMMED and 2 * trim >= n:
+            raise ValueError("trim too large for burst size")
+        self._adc = adc
+        # Bound once, a bound method is allocated on every attribute lookup
+        self._read = adc.read_u16
+        self._buf = array("H", [0] * n)
+        self.reducer = reducer
+        self.trim = trim
+        self.ema_shift = ema_shift
+        # EMA state in 24.8 fixed point, -1 until the first reading
+        self._ema = -1
+
+    def reset(self):
+        self._ema = -1
+
+    # Filtered reading, same 0 - 65535 scale as ADC.read_u16()
+    def read_u16(self):
+        buf = self._buf
+        n = len(buf)
+        read = self._read
+        for i in range(n):
+            buf[i] = read()
+
+        if self.reducer == REDUCE_MEAN:
+            value = _mean(buf, 0, n)
+        else:
+            _sort(buf)
+            if self.reducer == REDUCE_MEDIAN:
+                mid = n >> 1
+                value = buf[mid] if n & 1 else (buf[mid - 1] + buf[mid] + 1) >> 1
+            else:
+                value = _mean(buf, self.trim, n - self.trim)
+
+        if not self.ema_shift:
+            return value
+
+        if self._ema < 0:
+            self._ema = value << 8
+        else:
+            self._ema += ((value << 8) - self._ema) >> self.ema_shift
+        return (self._ema + 128) >> 8
+
+
+# Rounded mean of buf[start:end]
+def _mean(buf, start, end):
+    total = 0
+    for i in range(start, end):
+        total += buf[i]
+    count = end - start
+    return (total + (count >> 1)) // count
+
+
+# In-place insertion sort, fine for burst-sized buffers
+def _sort(buf):
+    for i in range(1, len(buf)):
+        value = buf[i]
+        j = i - 1
+        while j >= 0 and buf[j] > value:
+            buf[j + 1] = buf[j]
+            j -= 1
+        buf[j + 1] = value
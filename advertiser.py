@@ -0,0 +1,111 @@
+# Alarm-aware advertising scheduler.
+#
+# Advertising normally runs at the idle interval chosen by the power manager.
+# When the alarm level rises, or a central has just disconnected, it is
+# restarted at a fast interval for a short burst and then backs off in steps:
+#
+#   steps = ((20_000, 30_000), (100_000, 30_000), (250_000, 60_000))
+#           interval us, for ms     -> 20 ms for 30 s, 100 ms for 30 s, ...
+#
+# before returning to the idle interval. A step is never slower than the idle
+# interval. The advertised name carries the alarm level (names[level]) so
+# scanners can pick out a device in alert without connecting.
+#
+# Advertising is restarted whenever the interval or the name should change,
+# so a new alarm is on air straight away rather than at the next timeout.
+
+import time
+import uasyncio as asyncio
+
+from alarms import NORMAL
+
+
+class AdvertisingScheduler:
+    # advertise: aioble.advertise; idle_us(): current idle interval in us
+    def __init__(self, advertise, idle_us, names,
+                 steps=((20_000, 30_000), (100_000, 30_000), (250_000, 60_000)),
+                 max_slice_ms=30_000):
+        self._advertise = advertise
+        self._idle_us = idle_us
+        self.names = names
+        self.steps = steps
+        self.max_slice_ms = max_slice_ms
+        self.level = NORMAL
+        # Start of the current burst, None once it has backed off completely
+        self._burst_ms = None
+        self._restart = asyncio.Event()
+        # Number of bursts, for the diagnostics
+        self.bursts = 0
+
+    # Restart advertising at the fastest step
+    def burst(self):
+        self._burst_ms = time.ticks_ms()
+        self.bursts += 1
+        self._restart.set()
+
+    # Follow the alarm level: burst when it rises, update the name when it
+    # changes at all
+    def alarm(self, level):
+        if level == self.level:
+            return
+        rising = level > self.level
+        self.level = level
+        if rising:
+            self.burst()
+        else:
+            self._restart.set()
+
+    # Step of the current burst and the ms left in it, or (-1, 0) when idle
+    def _step(self):
+        if self._burst_ms is None:
+            return -1, 0
+        left = time.ticks_diff(time.ticks_ms(), self._burst_ms)
+        for i in range(len(self.steps)):
+            left -= self.steps[i][1]
+            if left < 0:
+                return i, -left
+        self._burst_ms = None
+        return -1, 0
+
+    def interval_us(self):
+        idle = self._idle_us()
+        i, _ = self._step()
+        if i < 0:
+            return idle
+        return min(self.steps[i][0], idle)
+
+    # How long to advertise before the interval should change
+    def slice_ms(self):
+        i, left = self._step()
+        if i < 0:
+            return self.max_slice_ms
+        return min(left, self.max_slice_ms)
+
+    # Advertise until a central connects (returns the connection) or the
+    # interval or name should change (returns None)
+    async def advertise(self, **kwargs):
+        self._restart.clear()
+        result = []
+
+        async def run():
+            try:
+                result.append(await self._advertise(
+                    interval_us=self.interval_us(),
+                    name=self.names[self.level],
+                    timeout_ms=self.slice_ms(),
+                    **kwargs
+                ))
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                self._restart.set()
+
+        task = asyncio.create_task(run())
+        await self._restart.wait()
+        if not task.done():
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        return result[0] if result else None
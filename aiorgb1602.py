@@ -0,0 +1,146 @@
+# Non-blocking driver for the RGB1602 LCD.
+#
+# Callers enqueue display operations and return immediately. A single
+# coroutine (run) drains the queue, performs the I2C writes and waits out the
+# controller's required delays with asyncio.sleep_ms, so display work never
+# blocks the BLE tasks sharing the event loop.
+
+from micropython import const
+import uasyncio as asyncio
+import RGB1602
+
+_OP_UPDATE = const(0)
+_OP_RGB = const(1)
+_OP_BLINK = const(2)
+_OP_NOBLINK = const(3)
+_OP_BRIGHTNESS = const(4)
+_OP_CLEAR = const(5)
+
+# Coalescing slot of each operation: a newly queued operation replaces a
+# pending one in the same slot, since only the latest can be visible.
+# Blink, no-blink and brightness all set the group control mode.
+_SLOT_NONE = const(-1)
+_SLOTS = (0, 1, 2, 2, 2, _SLOT_NONE)
+
+
+class AsyncRGB1602:
+    def __init__(self, col, row, queue_size=8):
+        self._lcd = RGB1602.RGB1602(col, row, begin=False)
+        self._col = col
+        self._row = row
+        self._queue = []
+        self._queue_size = queue_size
+        # Queue entries are recycled, so posting an operation does not
+        # allocate
+        self._free = [[0, None, None, None] for _ in range(queue_size)]
+        self._event = asyncio.Event()
+        self._ready = False
+        # Operations lost because the queue was full
+        self.dropped = 0
+
+    # Run the controller initialization sequence without blocking
+    async def begin(self):
+        for delay_ms in self._lcd.beginSteps(self._col, self._row):
+            await asyncio.sleep_ms(delay_ms)
+        self._ready = True
+
+    def update(self, line1, line2=""):
+        self._post(_OP_UPDATE, line1, line2, None)
+
+    def setRGB(self, r, g, b):
+        self._post(_OP_RGB, r, g, b)
+
+    def blinkLED(self, period_ms=1000, duty=128):
+        self._post(_OP_BLINK, period_ms, duty, None)
+
+    def noBlinkLED(self):
+        self._post(_OP_NOBLINK, None, None, None)
+
+    def setBrightness(self, level):
+        self._post(_OP_BRIGHTNESS, level, None, None)
+
+    def clear(self):
+        # Pending text updates would be wiped by the clear anyway
+        i = 0
+        while i < len(self._queue):
+            if self._queue[i][0] == _OP_UPDATE:
+                self._release(self._queue.pop(i))
+            else:
+                i += 1
+        self._post(_OP_CLEAR, None, None, None)
+
+    def pending(self):
+        return len(self._queue)
+
+    # I2C transactions and bytes sent so far by the driver
+    def i2c_counters(self):
+        return self._lcd.i2cTransactions, self._lcd.i2cBytes
+
+    def _post(self, op, a, b, c):
+        slot = _SLOTS[op]
+        if slot != _SLOT_NONE:
+            for entry in self._queue:
+                if _SLOTS[entry[0]] == slot:
+                    entry[0] = op
+                    entry[1] = a
+                    entry[2] = b
+                    entry[3] = c
+                    return
+
+        if len(self._queue) >= self._queue_size:
+            self._release(self._queue.pop(0))
+            self.dropped += 1
+
+        entry = self._free.pop()
+        entry[0] = op
+        entry[1] = a
+        entry[2] = b
+        entry[3] = c
+        self._queue.append(entry)
+        self._event.set()
+
+    def _release(self, entry):
+        entry[1] = entry[2] = entry[3] = None
+        self._free.append(entry)
+
+    # Perform one operation, except clear which needs a delay (see run)
+    def _execute(self, op, a, b, c):
+        lcd = self._lcd
+        if op == _OP_UPDATE:
+            lcd.update(a, b)
+        elif op == _OP_RGB:
+            lcd.setRGB(a, b, c)
+        elif op == _OP_BLINK:
+            lcd.blinkLED(a, b)
+        elif op == _OP_NOBLINK:
+            lcd.noBlinkLED()
+        elif op == _OP_BRIGHTNESS:
+            lcd.setBrightness(a)
+
+    # Drain the queue forever. Initializes the controller first if begin()
+    # has not been awaited yet; operations queued meanwhile are kept.
+    async def run(self):
+        if not self._ready:
+            await self.begin()
+
+        while True:
+            await self._event.wait()
+            self._event.clear()
+
+            while self._queue:
+                entry = self._queue.pop(0)
+                op, a, b, c = entry
+                self._release(entry)
+                try:
+                    if op == _OP_CLEAR:
+                        self._lcd.command(RGB1602.LCD_CLEARDISPLAY)
+                        await asyncio.sleep_ms(2)
+                        self._lcd.clearFramebuffer()
+                    else:
+                        self._execute(op, a, b, c)
+                except Exception:
+                    # The display may be out of step with the shadow copies
+                    self._lcd.invalidate()
+                    raise
+                # Yield between operations so BLE tasks get a turn
+                await asyncio.sleep_ms(0)
@@ -0,0 +1,148 @@
+# Table-driven gas alarm engine.
+#
+# Each gas has a row of thresholds in ppm (0 = not used):
+#   (warn, alert, twa, stel, hysteresis %)
+# and its level is the highest of:
+#   warning  the reading is at or above warn, or the 8-hour time-weighted
+#            average (TWA) is at or above twa
+#   alert    the reading is at or above alert, or the 15-minute short-term
+#            exposure (STEL) is at or above stel
+# A level, once reached, is held until its value drops hysteresis % below
+# the threshold, so a reading hovering at a limit does not flap.
+#
+# The rolling averages are kept in fixed rings of bucket means (15 x 1 min
+# and 32 x 15 min per gas), so memory and the work per sample stay constant
+# however long the device runs. Time the device was not sampling counts as
+# zero exposure, as in the OSHA definitions.
+
+from micropython import const
+from array import array
+import time
+
+NORMAL = const(0)
+WARNING = const(1)
+ALERT = const(2)
+
+# Longest gap between samples credited to the last reading
+_MAX_DT_MS = const(60_000)
+
+
+# Rolling time-weighted average over buckets x bucket_s seconds
+class Exposure:
+    def __init__(self, bucket_s, buckets):
+        # Bucket length in deciseconds keeps the running sum of a bucket
+        # within a small int (65535 ppm x 9000 ds < 2**30)
+        self._bucket_ds = bucket_s * 10
+        # Means of the last buckets - 1 closed buckets, oldest at _head
+        self._means = array("H", [0] * (buckets - 1))
+        self._head = 0
+        self._closed = 0
+        # ppm x ds and ds accumulated in the open bucket
+        self._sum = 0
+        self._elapsed = 0
+
+    # Credit ppm for dt_ds deciseconds
+    def add(self, ppm, dt_ds):
+        # Beyond a whole window the older part would be overwritten anyway
+        dt_ds = min(dt_ds, self._bucket_ds * (len(self._means) + 1))
+        while dt_ds > 0:
+            step = min(dt_ds, self._bucket_ds - self._elapsed)
+            self._sum += ppm * step
+            self._elapsed += step
+            dt_ds -= step
+            if self._elapsed >= self._bucket_ds:
+                self._close()
+
+    def _close(self):
+        mean = self._sum // self._bucket_ds
+        self._closed += mean - self._means[self._head]
+        self._means[self._head] = mean
+        self._head = (self._head + 1) % len(self._means)
+        self._sum = 0
+        self._elapsed = 0
+
+    # Average ppm over the closed buckets and the open one
+    def average(self):
+        # In units of 1/64 bucket to stay in small ints
+        b = self._bucket_ds
+        num = self._closed * 64 + (self._sum // b) * 64 + (self._sum % b) * 64 // b
+        den = len(self._means) * 64 + self._elapsed * 64 // b
+        return num // den
+
+    def clear(self):
+        for i in range(len(self._means)):
+            self._means[i] = 0
+        self._closed = 0
+        self._sum = 0
+        self._elapsed = 0
+
+
+def _over(value, limit, held, hysteresis):
+    if not limit:
+        return False
+    if held:
+        return value * 100 >= limit * (100 - hysteresis)
+    return value >= limit
+
+
+class AlarmEngine:
+    def __init__(self, table):
+        self.table = table
+        n = len(table)
+        self.levels = bytearray(n)
+        # Highest level of any gas
+        self.level = NORMAL
+        self.stel = [Exposure(60, 15) for _ in range(n)]
+        self.twa = [Exposure(900, 32) for _ in range(n)]
+        self._last_ms = -1
+        self._carry_ms = 0
+
+    # Feed one reading per gas taken at now_ms (time.ticks_ms())
+    def update(self, values, now_ms):
+        if self._last_ms < 0:
+            dt_ds = 0
+        else:
+            dt_ms = min(max(time.ticks_diff(now_ms, self._last_ms), 0), _MAX_DT_MS) + self._carry_ms
+            dt_ds = dt_ms // 100
+            self._carry_ms = dt_ms % 100
+        self._last_ms = now_ms
+
+        highest = NORMAL
+        levels = self.levels
+        for i in range(len(levels)):
+            value = values[i]
+            stel = self.stel[i]
+            twa = self.twa[i]
+            stel.add(value, dt_ds)
+            twa.add(value, dt_ds)
+
+            warn, alert, twa_limit, stel_limit, hysteresis = self.table[i]
+            current = levels[i]
+            level = NORMAL
+            if (_over(value, warn, current >= WARNING, hysteresis)
+                    or _over(twa.average(), twa_limit, current >= WARNING, hysteresis)):
+                level = WARNING
+            if (_over(value, alert, current >= ALERT, hysteresis)
+                    or _over(stel.average(), stel_limit, current >= ALERT, hysteresis)):
+                level = ALERT
+            levels[i] = level
+            if level > highest:
+                highest = level
+        self.level = highest
+        return highest
+
+    # Levels packed 2 bits per gas, first gas in bits 0-1
+    def flags(self):
+        flags = 0
+        for i in range(len(self.levels)):
+            flags |= self.levels[i] << (2 * i)
+        return flags
+
+    def clear(self):
+        for i in range(len(self.levels)):
+            self.levels[i] = NORMAL
+            self.stel[i].clear()
+            self.twa[i].clear()
+        self.level = NORMAL
+        self._last_ms = -1
+        self._carry_ms = 0
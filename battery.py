@@ -0,0 +1,65 @@
+# Adaptive battery monitor.
+#
+# Reading VSYS means reconfiguring GPIO25/29, which are shared with the CYW43
+# wireless chip, so every sample disturbs the radio. The battery level changes
+# over minutes, so after converging at boot the monitor backs off
+# exponentially while readings stay within a band of the rolling average. It
+# goes back to fast sampling as soon as a reading leaves that band (the
+# voltage is moving faster than the current interval can follow).
+# Samples are taken while holding radio_lock, which the BLE code holds during
+# notification bursts, so the pins are never swapped in the middle of one.
+
+import uasyncio as asyncio
+from ringbuf import RingBuffer
+
+
+class BatteryMonitor:
+    # measure() returns one battery percent reading (not clamped)
+    def __init__(self, measure, radio_lock=None, window=40, fast_ms=50,
+                 max_ms=60_000, band=3):
+        self._measure = measure
+        self._lock = radio_lock
+        self._values = RingBuffer(window)
+        self.fast_ms = fast_ms
+        self.max_ms = max_ms
+        # Allowed distance (percent) of a reading from the average before the
+        # estimate counts as moving
+        self.band = band
+        self.interval_ms = fast_ms
+        # Current estimate, clamped to 0 - 100
+        self.percent = 0
+        # Number of pin reconfigurations so far
+        self.samples = 0
+
+    # Start from an estimate carried over from before a reset
+    def restore(self, percent):
+        self.percent = percent
+
+    def sample(self):
+        value = self._measure()
+        self.samples += 1
+        values = self._values
+
+        if not values.full():
+            # Still converging, keep sampling fast
+            values.push(value)
+            self.interval_ms = self.fast_ms
+        elif abs(value - values.mean()) > self.band:
+            # Estimate is moving, follow it at the fast rate again
+            values.push(value)
+            self.interval_ms = self.fast_ms
+        else:
+            values.push(value)
+            self.interval_ms = min(self.interval_ms * 2, self.max_ms)
+
+        self.percent = min(100, max(0, round(values.mean())))
+        return self.percent
+
+    async def run(self):
+        while True:
+            if self._lock is None:
+                self.sample()
+            else:
+                async with self._lock:
+                    self.sample()
+            await asyncio.sleep_ms(self.interval_ms)
@@ -18,10 +18,19 @@ _ADV_TYPE_UUID16_MORE = const(0x2)
 _ADV_TYPE_UUID32_MORE = const(0x4)
 _ADV_TYPE_UUID128_MORE = const(0x6)
 _ADV_TYPE_APPEARANCE = const(0x19)
+_ADV_TYPE_MANUFACTURER = const(0xFF)
+
+# Legacy advertising packets carry at most 31 bytes
+_ADV_MAX_PAYLOAD = const(31)
+# Manufacturer data always follows the flags, so its value (company ID
+# first) starts at this offset and can be rewritten in place
+MANUFACTURER_OFFSET = const(5)
 
 
 # Generate a payload to be passed to gap_advertise(adv_data=...).
-def advertising_payload(limited_disc=False, br_edr=False, name=None, services=None, appearance=0):
+# manufacturer: company ID (u16, little endian) followed by the data.
+def advertising_payload(limited_disc=False, br_edr=False, name=None, services=None, appearance=0,
+                        manufacturer=None):
     payload = bytearray()
 
     def _append(adv_type, value):
@@ -33,6 +42,9 @@ def advertising_payload(limited_disc=False, br_edr=False, name=None, services=No
         struct.pack("B", (0x01 if limited_disc else 0x02) + (0x18 if br_edr else 0x04)),
     )
 
+    if manufacturer:
+        _append(_ADV_TYPE_MANUFACTURER, manufacturer)
+
     if name:
         _append(_ADV_TYPE_NAME, name)
 
@@ -50,4 +62,6 @@ def advertising_payload(limited_disc=False, br_edr=False, name=None, services=No
     if appearance:
         _append(_ADV_TYPE_APPEARANCE, struct.pack("<h", appearance))
 
+    if len(payload) > _ADV_MAX_PAYLOAD:
+        raise ValueError("advertising payload too long")
     return payload
@@ -0,0 +1,88 @@
+# Clean-air calibration of the gas sensors.
+#
+# Each channel's sensor resistance is sampled into a streaming (Welford)
+# mean and variance. Sampling stops as soon as the confidence interval of
+# every mean is narrower than rel_ci of the mean, instead of after a fixed
+# time, so a quiet sensor in stable air is done in seconds. The means are
+# the new clean-air Ro values; they are saved to a small JSON file that
+# main.py reads at boot.
+
+import json
+import math
+import os
+import time
+import uasyncio as asyncio
+
+
+class Welford:
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+
+    def add(self, x):
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self._m2 += delta * (x - self.mean)
+
+    def variance(self):
+        return self._m2 / (self.n - 1) if self.n > 1 else 0.0
+
+    # Half width of the confidence interval of the mean (z = 1.96 for 95 %)
+    def ci(self, z=1.96):
+        if self.n < 2:
+            return math.inf
+        return z * math.sqrt(self.variance() / self.n)
+
+
+class Calibration:
+    # reads: one function per channel returning the sensor resistance
+    def __init__(self, reads, rel_ci=0.01, min_samples=20, max_samples=3000,
+                 period_ms=200):
+        self.reads = reads
+        self.rel_ci = rel_ci
+        self.min_samples = min_samples
+        self.max_samples = max_samples
+        self.period_ms = period_ms
+        self.stats = [Welford() for _ in reads]
+        self.elapsed_ms = 0
+
+    def converged(self):
+        for s in self.stats:
+            if s.n < self.min_samples or s.ci() > self.rel_ci * abs(s.mean):
+                return False
+        return True
+
+    # Sample until converged; returns the mean of each channel, or None if
+    # max_samples passed without converging (air not clean or stable)
+    async def run(self):
+        started = time.ticks_ms()
+        try:
+            for _ in range(self.max_samples):
+                for i in range(len(self.reads)):
+                    self.stats[i].add(self.reads[i]())
+                if self.converged():
+                    return [s.mean for s in self.stats]
+                await asyncio.sleep_ms(self.period_ms)
+            return None
+        finally:
+            self.elapsed_ms = time.ticks_diff(time.ticks_ms(), started)
+
+
+# Settings saved by save(), or {} when there are none
+def load(path):
+    try:
+        with open(path) as f:
+            values = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return values if isinstance(values, dict) else {}
+
+
+# Write through a temporary file, so a reset mid-write keeps the old values
+def save(path, values):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(values, f)
+    os.rename(tmp, path)
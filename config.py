@@ -0,0 +1,193 @@
+# Runtime settings and the binary command protocol that changes them.
+#
+# Every setting has a one-byte key, a name, an allowed range and a function
+# that applies it to the running objects. A batch of (key, value) pairs is
+# checked as a whole before any of it is applied, so one bad entry leaves
+# every setting as it was. Values that differ from the defaults are kept in
+# a JSON file by name (written through a temporary file) and applied again
+# at boot.
+#
+# Protocol, on the command characteristic. A request is an opcode byte
+# followed by its arguments, little endian; opcodes are below 0x20 so they
+# never collide with the text commands. The response is the opcode with
+# bit 7 set, a status byte and the opcode's data:
+#   0x01 SET      (key u8, value i32) * n  -> status, key u8 of the bad entry
+#   0x02 GET      key u8 * n, none for all -> status, (key u8, value i32) * n
+#   0x03 PROFILE  profile u8               -> status
+#   0x04 RESET    back to the defaults     -> status
+# SET, PROFILE and RESET are saved to flash when they change anything. If
+# that fails the status is ERR_STORAGE: the new values are in use but will
+# not survive a reboot.
+
+from micropython import const
+import errno
+import json
+import os
+import struct
+
+SET = const(0x01)
+GET = const(0x02)
+PROFILE = const(0x03)
+RESET = const(0x04)
+
+OK = const(0)
+ERR_OPCODE = const(1)
+ERR_LENGTH = const(2)
+ERR_KEY = const(3)
+ERR_RANGE = const(4)
+ERR_STORAGE = const(5)
+
+_ENTRY = "<Bi"
+_ENTRY_SIZE = const(5)
+
+
+# True if data is a binary request rather than a text command
+def is_binary(data):
+    return len(data) > 0 and data[0] < 0x20
+
+
+class Settings:
+    def __init__(self, path="config.json"):
+        self.path = path
+        # Keys in the order they were added, and per key
+        # [name, low, high, default, value, apply]
+        self.keys = bytearray()
+        self._entries = {}
+
+    # apply(value) is called with the default straight away
+    def add(self, key, name, low, high, default, apply):
+        self.keys.append(key)
+        self._entries[key] = [name, low, high, default, default, apply]
+        apply(default)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        return self._entries[key][4]
+
+    # Check a batch of (key, value); returns (status, key of the bad entry)
+    def check(self, pairs):
+        for key, value in pairs:
+            entry = self._entries.get(key)
+            if entry is None:
+                return ERR_KEY, key
+            if not entry[1] <= value <= entry[2]:
+                return ERR_RANGE, key
+        return OK, 0
+
+    # Apply a batch atomically and save it if anything changed. A failed
+    # save leaves the batch applied and returns ERR_STORAGE.
+    def set(self, pairs):
+        status, key = self.check(pairs)
+        if status != OK:
+            return status, key
+        changed = False
+        for key, value in pairs:
+            entry = self._entries[key]
+            if entry[4] != value:
+                entry[4] = value
+                entry[5](value)
+                changed = True
+        if changed:
+            try:
+                self.save()
+            except OSError:
+                return ERR_STORAGE, 0
+        return OK, 0
+
+    # Back to the defaults; returns ERR_STORAGE if the saved file is left
+    def reset(self):
+        for key in self.keys:
+            entry = self._entries[key]
+            if entry[4] != entry[3]:
+                entry[4] = entry[3]
+                entry[5](entry[3])
+        try:
+            os.remove(self.path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                return ERR_STORAGE
+        return OK
+
+    # Apply the saved values, skipping any that no longer fit
+    def load(self):
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return
+        if not isinstance(saved, dict):
+            return
+        for key in self.keys:
+            entry = self._entries[key]
+            value = saved.get(entry[0])
+            if isinstance(value, int) and entry[1] <= value <= entry[2]:
+                entry[4] = value
+                entry[5](value)
+
+    def save(self):
+        values = {}
+        for key in self.keys:
+            entry = self._entries[key]
+            if entry[4] != entry[3]:
+                values[entry[0]] = entry[4]
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(values, f)
+        os.rename(tmp, self.path)
+
+
+class CommandProtocol:
+    # profiles: one batch of (key, value) per profile number. Every setting
+    # must be added before, the response buffer is sized for all of them.
+    def __init__(self, settings, profiles=()):
+        self.settings = settings
+        self.profiles = profiles
+        self._response = bytearray(3 + _ENTRY_SIZE * len(settings.keys))
+
+    # Handle one request; returns the response (valid until the next call)
+    def handle(self, data):
+        data = memoryview(data)
+        opcode = data[0]
+        args = data[1:]
+        out = self._response
+        out[0] = opcode | 0x80
+        length = 2
+        status = OK
+        if opcode == SET:
+            if not args or len(args) % _ENTRY_SIZE:
+                status = ERR_LENGTH
+            else:
+                pairs = [struct.unpack_from(_ENTRY, args, i)
+                         for i in range(0, len(args), _ENTRY_SIZE)]
+                status, key = self.settings.set(pairs)
+                if status == ERR_KEY or status == ERR_RANGE:
+                    out[2] = key
+                    length = 3
+        elif opcode == GET:
+            keys = args if args else self.settings.keys
+            if len(keys) > len(self.settings.keys):
+                status = ERR_LENGTH
+            else:
+                for key in keys:
+                    if key not in self.settings:
+                        status = ERR_KEY
+                        out[2] = key
+                        length = 3
+                        break
+                    struct.pack_into(_ENTRY, out, length, key, self.settings.get(key))
+                    length += _ENTRY_SIZE
+        elif opcode == PROFILE:
+            if len(args) != 1:
+                status = ERR_LENGTH
+            elif args[0] >= len(self.profiles):
+                status = ERR_RANGE
+            else:
+                status, key = self.settings.set(self.profiles[args[0]])
+        elif opcode == RESET:
+            status = self.settings.reset()
+        else:
+            status = ERR_OPCODE
+        out[1] = status
+        return memoryview(out)[:length]
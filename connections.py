@@ -0,0 +1,78 @@
+# Connection manager for the GATT server.
+#
+# Owns every task that belongs to a connected central. When the central
+# disconnects all of its tasks are cancelled and joined, so nothing keeps
+# running against a dead connection handle. Up to max_connections centrals
+# can be connected at once; readings are fanned out to all of them by a
+# single sender instead of one sampling loop per connection.
+
+import uasyncio as asyncio
+
+
+class ConnectionManager:
+    # on_disconnect(connection) is called when a central goes away
+    def __init__(self, max_connections=1, log=print, on_disconnect=None):
+        self.max_connections = max_connections
+        # Currently connected centrals, safe to iterate between awaits
+        self.active = []
+        self._tasks = {}
+        self._slot_free = asyncio.Event()
+        self._log = log
+        self._on_disconnect = on_disconnect
+
+    def __len__(self):
+        return len(self.active)
+
+    def full(self):
+        return len(self.active) >= self.max_connections
+
+    async def wait_slot(self):
+        while self.full():
+            self._slot_free.clear()
+            await self._slot_free.wait()
+
+    # Take ownership of a new connection; it is closed when the central
+    # disconnects
+    def open(self, connection):
+        self.active.append(connection)
+        self._tasks[connection] = []
+        self.spawn(connection, self._watch(connection))
+
+    # Run coro as a task owned by connection
+    def spawn(self, connection, coro):
+        tasks = self._tasks.get(connection)
+        if tasks is None:
+            # Already gone
+            coro.close()
+            return None
+        # Drop finished tasks so the list does not grow over a long session
+        tasks[:] = [task for task in tasks if not task.done()]
+        task = asyncio.create_task(coro)
+        tasks.append(task)
+        return task
+
+    async def _watch(self, connection):
+        await connection.disconnected(timeout_ms=None)
+        self._log("Device disconnected:", connection.device)
+        if self._on_disconnect:
+            self._on_disconnect(connection)
+        # close() cancels this task as well, so run it separately
+        asyncio.create_task(self.close(connection))
+
+    # Cancel and join every task owned by connection
+    async def close(self, connection):
+        tasks = self._tasks.pop(connection, None)
+        if tasks is None:
+            return
+        self.active.remove(connection)
+        self._slot_free.set()
+
+        for task in tasks:
+            task.cancel()
+        for task in tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+            except Exception as e:
+                self._log("Connection task failed:", repr(e))
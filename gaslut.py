@@ -0,0 +1,104 @@
+# Lookup tables from raw ADC code to gas concentration.
+#
+# Converting a reading to ppm takes a log10 and a pow in software floating
+# point. The calibration constants are fixed, so the whole curve is tabulated
+# once (at boot, or loaded from flash) at a reduced ADC resolution and
+# readings are linearly interpolated between table entries with integer math.
+
+from micropython import const
+from array import array
+import struct
+
+# Table entries saturate at this value, the largest ppm a <H field can carry
+_PPM_MAX = const(65535)
+_HEADER = "<4sB3f"
+_MAGIC = b"GLUT"
+
+
+class GasLUT:
+    # bits: table resolution; the RP2040 ADC is 12-bit, so 12 bits gives one
+    # entry per real conversion code
+    def __init__(self, bits=12):
+        self._shift = 16 - bits
+        self._mask = (1 << self._shift) - 1
+        # One extra entry so the last interval can be interpolated
+        self._table = array("H", [0] * ((1 << bits) + 1))
+
+    # Fill the table from convert(raw) -> ppm, the float conversion path
+    def build(self, convert):
+        for _ in self.build_steps(convert):
+            pass
+
+    # Same as build() as a generator that yields after every chunk entries,
+    # so a coroutine can rebuild a table without stalling the event loop
+    def build_steps(self, convert, chunk=256):
+        table = self._table
+        for i in range(len(table)):
+            table[i] = _saturate(convert, min(i << self._shift, 65535))
+            if i % chunk == chunk - 1:
+                yield
+
+    # ppm for a 16-bit raw code
+    def ppm(self, raw):
+        i = raw >> self._shift
+        lo = self._table[i]
+        frac = raw & self._mask
+        if not frac:
+            return lo
+        hi = self._table[i + 1]
+        return lo + (((hi - lo) * frac + (1 << (self._shift - 1))) >> self._shift)
+
+    # Number of codes (sampled every step) where the table is further than
+    # rel (fraction) and abs_ (ppm) from the float path
+    def check(self, convert, rel=0.05, abs_=2, step=97):
+        bad = 0
+        for raw in range(1, 65536, step):
+            expected = _saturate(convert, raw)
+            error = abs(self.ppm(raw) - expected)
+            if error > abs_ and error > rel * expected:
+                bad += 1
+        return bad
+
+    # key identifies the calibration the table was built for
+    def save(self, path, key):
+        with open(path, "wb") as f:
+            f.write(struct.pack(_HEADER, _MAGIC, 16 - self._shift, *key))
+            f.write(self._table)
+
+    # Load a table saved for the same key and resolution, False otherwise
+    def load(self, path, key):
+        try:
+            with open(path, "rb") as f:
+                header = f.read(struct.calcsize(_HEADER))
+                if header != struct.pack(_HEADER, _MAGIC, 16 - self._shift, *key):
+                    return False
+                return f.readinto(self._table) == len(self._table) * 2
+        except OSError:
+            return False
+
+
+# Load the table for key from path, or build (and save) it when the file is
+# missing, was made for other calibration constants or fails the check
+# against the float path
+def cached_lut(path, convert, key, bits=12):
+    lut = GasLUT(bits)
+    if lut.load(path, key) and not lut.check(convert):
+        return lut
+    lut.build(convert)
+    try:
+        lut.save(path, key)
+    except OSError:
+        pass
+    return lut
+
+
+def _saturate(convert, raw):
+    try:
+        ppm = convert(max(raw, 1))
+    except (OverflowError, ZeroDivisionError):
+        return _PPM_MAX
+    if ppm < 0:
+        return 0
+    if ppm >= _PPM_MAX:
+        return _PPM_MAX
+    return int(ppm)
@@ -0,0 +1,143 @@
+# On-device history of readings with tiered rollups.
+#
+# Three fixed-size circular tiers of compact binary records, so the memory
+# used never grows:
+#   TIER_RAW    one sample every raw_period_s seconds
+#   TIER_MINUTE min/mean/max of every sample in each minute
+#   TIER_HOUR   min/mean/max of every sample in each hour
+# Rollups are accumulated incrementally as samples arrive.
+#
+# Records are addressed by an absolute record number (the count of records
+# ever appended to the tier), so a reader walking a tier while new records
+# arrive never sees one twice; records that were overwritten are skipped.
+
+from micropython import const
+import struct
+
+TIER_RAW = const(0)
+TIER_MINUTE = const(1)
+TIER_HOUR = const(2)
+
+# timestamp s, CO, CH4, CO2, battery
+RAW_FORMAT = "<IHHHB"
+# timestamp s (start of the period), CO min/mean/max, CH4 min/mean/max,
+# CO2 min/mean/max, mean battery
+ROLLUP_FORMAT = "<I9HB"
+
+
+class Tier:
+    def __init__(self, fmt, capacity):
+        self.fmt = fmt
+        self.record_size = struct.calcsize(fmt)
+        self.capacity = capacity
+        self._buf = bytearray(self.record_size * capacity)
+        self._mv = memoryview(self._buf)
+        # Number of records ever appended
+        self.total = 0
+
+    # Record number of the oldest record still held
+    def first(self):
+        return max(0, self.total - self.capacity)
+
+    def append(self, *values):
+        struct.pack_into(self.fmt, self._buf, (self.total % self.capacity) * self.record_size, *values)
+        self.total += 1
+
+    def timestamp(self, n):
+        return struct.unpack_from("<I", self._buf, (n % self.capacity) * self.record_size)[0]
+
+    # Memoryview of the packed record n
+    def record(self, n):
+        offset = (n % self.capacity) * self.record_size
+        return self._mv[offset:offset + self.record_size]
+
+    # Record number of the first record at or after timestamp ts (records are
+    # in time order, so this is a binary search)
+    def find(self, ts):
+        lo = self.first()
+        hi = self.total
+        while lo < hi:
+            mid = (lo + hi) >> 1
+            if self.timestamp(mid) < ts:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+
+# Running min/mean/max of the three gases and mean battery over one period
+class _Rollup:
+    def __init__(self, period_s):
+        self.period_s = period_s
+        self.start = -1
+        self._min = [0, 0, 0]
+        self._max = [0, 0, 0]
+        self._sum = [0, 0, 0]
+        self._batt = 0
+        self._count = 0
+
+    def add(self, values, batt):
+        for i in range(3):
+            v = values[i]
+            if not self._count or v < self._min[i]:
+                self._min[i] = v
+            if not self._count or v > self._max[i]:
+                self._max[i] = v
+            self._sum[i] += v
+        self._batt += batt
+        self._count += 1
+
+    def emit(self, tier):
+        n = self._count
+        if not n:
+            return
+        mn = self._min
+        mx = self._max
+        s = self._sum
+        tier.append(
+            self.start,
+            mn[0], (s[0] + n // 2) // n, mx[0],
+            mn[1], (s[1] + n // 2) // n, mx[1],
+            mn[2], (s[2] + n // 2) // n, mx[2],
+            (self._batt + n // 2) // n,
+        )
+        for i in range(3):
+            s[i] = 0
+        self._batt = 0
+        self._count = 0
+
+
+class History:
+    def __init__(self, raw_period_s=10, raw_capacity=360, minute_capacity=360,
+                 hour_capacity=168):
+        self.raw_period_s = raw_period_s
+        self._tiers = (
+            Tier(RAW_FORMAT, raw_capacity),
+            Tier(ROLLUP_FORMAT, minute_capacity),
+            Tier(ROLLUP_FORMAT, hour_capacity),
+        )
+        self._rollups = (_Rollup(60), _Rollup(3600))
+        self._last_raw = -1
+        self._values = [0, 0, 0]
+
+    def tier(self, n):
+        return self._tiers[n]
+
+    # Add one sample taken at ts (seconds)
+    def add(self, ts, co, ch4, co2, batt):
+        if self._last_raw < 0 or ts - self._last_raw >= self.raw_period_s:
+            self._tiers[TIER_RAW].append(ts, co, ch4, co2, batt)
+            self._last_raw = ts
+
+        values = self._values
+        values[0] = co
+        values[1] = ch4
+        values[2] = co2
+        for i in range(2):
+            rollup = self._rollups[i]
+            start = ts - ts % rollup.period_s
+            if start != rollup.start:
+                if rollup.start >= 0:
+                    rollup.emit(self._tiers[TIER_MINUTE + i])
+                rollup.start = start
+            rollup.add(values, batt)
@@ -0,0 +1,335 @@
+# Benchmarks of the firmware hot paths under CPython.
+#
+# main.py is imported on top of the stand-ins in host/sim (fake machine,
+# bluetooth, aioble, micropython), its tasks are driven by samples taken
+# from scripted ADC readings, and the cost of each path is measured:
+#   sample_us               time per sample of the sampler: ADC bursts,
+#                           lookup tables and alarm engine
+#   lcd_us / transmit_us    time per iteration of lcd_task (including the
+#                           display queue) and of transmit_data
+#   i2c_tx / i2c_bytes      I2C transactions and bytes per LCD refresh
+#   alloc_ops               operations per iteration that allocate on the
+#                           MicroPython heap, found by heapaudit.Audit
+#   alloc_net / alloc_peak  CPython heap growth per iteration, and the most
+#                           memory allocated within one iteration beyond what
+#                           sampling and scheduling alone take (tracemalloc);
+#                           for information only, CPython frees garbage by
+#                           reference counting so neither shows the churn
+#                           the same code causes on the board
+#   notify_per_s            notifications per second to one central
+#
+# CPython timings are only meaningful relative to each other, but the I2C,
+# allocation and notification figures track the firmware directly. Compare
+# against a saved run to catch regressions:
+#
+#   python bench.py --save baseline.json
+#   python bench.py --check baseline.json --tolerance 0.5
+#
+# Every run also fails, listing the source lines, if the loops allocate at
+# all. test_heap.py runs the same check as a unit test.
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+HOST = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HOST, "sim"))
+sys.path.insert(0, os.path.dirname(HOST))
+
+import uasyncio  # noqa: E402,F401  (makes asyncio answer to uasyncio)
+import aioble  # noqa: E402
+import machine  # noqa: E402
+import RGB1602  # noqa: E402
+from heapaudit import Audit  # noqa: E402
+
+# Raw ADC codes of the MQ-7, MQ-4 and MQ-135 and the battery percent, one
+# set per sample. They go in through the machine.ADC stand-ins, so every
+# sample runs the firmware's own acquire().
+SCENARIOS = {
+    # Nothing changes, the steady state of a quiet room
+    "steady": lambda n: (3000, 2000, 2000, 80),
+    # Every channel moves every sample
+    "changing": lambda n: (3000 + 2 * (n % 200), 1000 + 20 * (n % 100), 2000 + 10 * (n % 90),
+                           80 - n % 3),
+}
+# ADC pin of each scenario channel: MQ-7, MQ-4, MQ-135
+_PINS = (27, 28, 26)
+# Yields that let a woken task (and the display queue behind it) finish
+_SETTLE = 8
+_ROUND = 10
+# Samples checked by the heap audit (tracing is slow)
+_AUDIT_SAMPLES = 50
+# Every consumer awaits the next sample once per iteration. MicroPython
+# allocates that coroutine, which is the price of sharing one sampler
+# between tasks, so it is not counted.
+_AUDIT_ALLOW = ("Sampler.next",)
+
+
+def _import_main(workdir):
+    # LUT and recording files are written to the working directory
+    os.chdir(workdir)
+    import main
+
+    main.log.echo = False
+    main.supervisor.add("sampler", main.sampler.run, critical=True)
+    main.supervisor.add("lcd", main.lcd_task, critical=True)
+    return main
+
+
+# Set the readings the next sample will take
+def _feed(main, readings):
+    for pin, raw in zip(_PINS, readings):
+        machine.set_waveform(pin, machine.constant(raw))
+    main.battery.percent = readings[3]
+
+
+async def _settle():
+    for _ in range(_SETTLE):
+        await asyncio.sleep(0)
+
+
+# Take n samples of the scenario, letting the consumers run after each one.
+# Returns the time per sample in us spent by the consumers and by the
+# sampler. For the consumers: the fastest of the rounds of _ROUND samples,
+# less the sampling and the fastest round of the same scheduling without a
+# sample.
+async def _drive(main, scenario, n, start=0):
+    values = SCENARIOS[scenario]
+    count = start
+    per_round = min(n, _ROUND)
+    work = overhead = sampling = None
+    for _ in range((n + per_round - 1) // per_round):
+        started = time.perf_counter_ns()
+        for _ in range(per_round):
+            await _settle()
+        elapsed = time.perf_counter_ns() - started
+        if overhead is None or elapsed < overhead:
+            overhead = elapsed
+
+        sampled = 0
+        started = time.perf_counter_ns()
+        for _ in range(per_round):
+            count += 1
+            _feed(main, values(count))
+            before = time.perf_counter_ns()
+            main.sampler.sample()
+            sampled += time.perf_counter_ns() - before
+            await _settle()
+        elapsed = time.perf_counter_ns() - started - sampled
+        if work is None or elapsed < work:
+            work = elapsed
+        if sampling is None or sampled < sampling:
+            sampling = sampled
+    return max(0, work - overhead) / per_round / 1000, sampling / per_round / 1000
+
+
+# Heap growth per sample and the largest amount allocated within one sample.
+# Growth excludes the stand-ins, which keep every notification they record.
+async def _allocations(main, scenario, n):
+    tracemalloc.start()
+    await _drive(main, scenario, n)
+    values = SCENARIOS[scenario]
+    exclude = [tracemalloc.Filter(False, os.path.join(HOST, "sim", "*")),
+               tracemalloc.Filter(False, tracemalloc.__file__)]
+    before = tracemalloc.take_snapshot().filter_traces(exclude)
+    peak = 0
+    for i in range(n):
+        _feed(main, values(i))
+        current, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        main.sampler.sample()
+        await _settle()
+        peak = max(peak, tracemalloc.get_traced_memory()[1] - current)
+    after = tracemalloc.take_snapshot().filter_traces(exclude)
+    tracemalloc.stop()
+    net = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    return net / n, peak
+
+
+# Operations that allocate on the MicroPython heap per sample, and where
+# they are ({"file:line what": count per sample}). The consumers must
+# already be running; a warm-up sample lets the audit see their frames.
+async def audit(main, scenario, n=_AUDIT_SAMPLES):
+    firmware = Audit([os.path.dirname(HOST)], exclude=[HOST], allow=_AUDIT_ALLOW)
+    with firmware:
+        await _drive(main, scenario, 2)
+    firmware.clear()
+    with firmware:
+        await _drive(main, scenario, n, start=2)
+    return {site: count / n for site, count in firmware.found.items()}
+
+
+async def _run_task(coro):
+    task = asyncio.create_task(coro)
+    await _settle()
+    return task
+
+
+async def _stop(*tasks):
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+# The sampler on its own, with the snapshot kept for a reset
+async def bench_sample(main, scenario, n):
+    task = await _run_task(main.retain_task())
+    _, us = await _drive(main, scenario, n)
+    result = {"sample_us": us, "alloc_sites": await audit(main, scenario)}
+    await _stop(task)
+    return result
+
+
+async def bench_lcd(main, scenario, n):
+    await main.LCD.begin()
+    bus = RGB1602.RGB1602_I2C
+    _, base_peak = await _allocations(main, scenario, n)
+    tasks = [await _run_task(main.LCD.run()), await _run_task(main.lcd_task())]
+    # First refresh draws the whole screen
+    await _drive(main, scenario, 1)
+    bus.reset_counters()
+    seq = main.sampler._seq
+    us, _ = await _drive(main, scenario, n, start=1)
+    refreshes = (main.sampler._seq - seq) & 0xFFFF
+    result = {
+        "lcd_us": us,
+        "i2c_tx": bus.transactions / refreshes,
+        "i2c_bytes": bus.bytes_written / refreshes,
+    }
+    result["alloc_net"], peak = await _allocations(main, scenario, n)
+    result["alloc_peak"] = max(0, peak - base_peak)
+    result["alloc_sites"] = await audit(main, scenario)
+    await _stop(*tasks)
+    return result
+
+
+async def bench_transmit(main, scenario, n):
+    central = aioble.add_central()
+    main.connections.open(central)
+    main.notify_policy.reset()
+    chars = [main.measurement_characteristic, main.co_characteristic, main.ch4_characteristic,
+             main.co2_characteristic, main.batt_characteristic]
+    for c in chars:
+        c.notifications.clear()
+
+    _, base_peak = await _allocations(main, scenario, n)
+    task = await _run_task(main.transmit_data())
+    seq = main.sampler._seq
+    us, _ = await _drive(main, scenario, n)
+    samples = (main.sampler._seq - seq) & 0xFFFF
+    notifications = sum(len(c.notifications) for c in chars)
+    result = {
+        "transmit_us": us,
+        "notify_per_s": notifications / samples * 1000 / main.sampler.period_ms,
+    }
+    result["alloc_net"], peak = await _allocations(main, scenario, n)
+    result["alloc_peak"] = max(0, peak - base_peak)
+    result["alloc_sites"] = await audit(main, scenario)
+    await _stop(task)
+    central.drop()
+    await main.connections.close(central)
+    return result
+
+
+# Returns the metrics per scenario, and the allocating sites per scenario
+# and path
+async def run_all(main, n):
+    # Warm up, the first pass pays for one-off allocations and imports
+    await bench_lcd(main, "changing", 50)
+    await bench_transmit(main, "changing", 50)
+    results = {}
+    sites = {}
+    for scenario in SCENARIOS:
+        sample = await bench_sample(main, scenario, n)
+        lcd = await bench_lcd(main, scenario, n)
+        transmit = await bench_transmit(main, scenario, n)
+        results[scenario] = {
+            "sample_us": sample["sample_us"],
+            "sample_alloc_ops": sum(sample["alloc_sites"].values()),
+            "lcd_us": lcd["lcd_us"],
+            "i2c_tx": lcd["i2c_tx"],
+            "i2c_bytes": lcd["i2c_bytes"],
+            "lcd_alloc_ops": sum(lcd["alloc_sites"].values()),
+            "lcd_alloc_net": lcd["alloc_net"],
+            "lcd_alloc_peak": lcd["alloc_peak"],
+            "transmit_us": transmit["transmit_us"],
+            "transmit_alloc_ops": sum(transmit["alloc_sites"].values()),
+            "transmit_alloc_net": transmit["alloc_net"],
+            "transmit_alloc_peak": transmit["alloc_peak"],
+            "notify_per_s": transmit["notify_per_s"],
+        }
+        sites[scenario + " sample"] = sample["alloc_sites"]
+        sites[scenario + " lcd"] = lcd["alloc_sites"]
+        sites[scenario + " transmit"] = transmit["alloc_sites"]
+    return results, sites
+
+
+def report(results):
+    metrics = list(next(iter(results.values())))
+    print("%-20s" % "metric" + "".join("%12s" % s for s in results))
+    for metric in metrics:
+        print("%-20s" % metric + "".join("%12.2f" % results[s][metric] for s in results))
+
+
+# Metrics that got worse than the baseline by more than tolerance (all of
+# them are lower-is-better). Timings get the tolerance, counts get a small
+# absolute slack since they should not move at all.
+def regressions(results, baseline, tolerance):
+    failed = []
+    for scenario, metrics in baseline.items():
+        for metric, old in metrics.items():
+            new = results.get(scenario, {}).get(metric)
+            if new is None:
+                continue
+            if metric.endswith("_us"):
+                limit = old * (1 + tolerance)
+            else:
+                limit = old + max(0.01, abs(old) * 0.01)
+            if new > limit:
+                failed.append((scenario, metric, old, new))
+    return failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the firmware hot paths under CPython")
+    parser.add_argument("-n", "--iterations", type=int, default=500, help="samples per benchmark")
+    parser.add_argument("--save", metavar="FILE", help="write the results as JSON")
+    parser.add_argument("--check", metavar="FILE", help="fail if worse than these saved results")
+    parser.add_argument("--tolerance", type=float, default=0.5, help="allowed slowdown for timings")
+    args = parser.parse_args(argv)
+
+    save = os.path.abspath(args.save) if args.save else None
+    baseline = None
+    if args.check:
+        with open(args.check) as f:
+            baseline = json.load(f)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        firmware = _import_main(workdir)
+        results, sites = asyncio.run(run_all(firmware, args.iterations))
+        os.chdir(HOST)
+
+    report(results)
+    if save:
+        with open(save, "w") as f:
+            json.dump(results, f, indent=2)
+    failed = False
+    for path, found in sites.items():
+        for site, count in sorted(found.items()):
+            print("ALLOCATES %s: %s (%.2f per iteration)" % (path, site, count))
+            failed = True
+    if baseline is not None:
+        for scenario, metric, old, new in regressions(results, baseline, args.tolerance):
+            print("REGRESSION %s %s: %.2f -> %.2f" % (scenario, metric, old, new))
+            failed = True
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
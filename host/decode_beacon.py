@@ -0,0 +1,110 @@
+# Decode the readings that sensor boards broadcast in their advertising
+# (ENABLE_BROADCAST in main.py), without connecting to them.
+#
+#   python decode_beacon.py 0201060dffffff010300000c00a80100000b094761732053656e736f72
+#   python decode_beacon.py --scan 30                # listen with bleak for 30 s
+# or from Python:
+#   from decode_beacon import decode, parse_payload
+#   decode(advertisement_data.manufacturer_data)     # bleak
+#   decode(parse_payload(raw)[0xFF])                 # raw payload bytes
+#
+# The frame layout is documented in main.py next to _BEACON_FORMAT; the
+# constants below must match it.
+
+import argparse
+import asyncio
+import struct
+import sys
+
+COMPANY = 0xFFFF
+VERSION = 1
+# Frame after the company ID: version, counter, CO, CH4, CO2, battery, flags
+FRAME = "<BBHHHBB"
+LEVELS = ("normal", "warning", "alert")
+GASES = ("co", "ch4", "co2")
+
+
+# AD structures of an advertising payload as {type: value}
+def parse_payload(payload):
+    fields = {}
+    i = 0
+    while i + 1 < len(payload):
+        length = payload[i]
+        if length == 0:
+            break
+        fields[payload[i + 1]] = bytes(payload[i + 2:i + 1 + length])
+        i += 1 + length
+    return fields
+
+
+# Readings of one frame as a dict, or None if it is not from a sensor board.
+# data is either the manufacturer data (company ID first) or bleak's
+# {company ID: data} dict.
+def decode(data):
+    if isinstance(data, dict):
+        data = data.get(COMPANY)
+        if data is None:
+            return None
+    else:
+        if len(data) < 2 or struct.unpack_from("<H", data)[0] != COMPANY:
+            return None
+        data = data[2:]
+    if len(data) != struct.calcsize(FRAME):
+        return None
+    version, counter, co, ch4, co2, batt, flags = struct.unpack(FRAME, data)
+    if version != VERSION:
+        return None
+    reading = {"counter": counter, "co": co, "ch4": ch4, "co2": co2, "batt": batt}
+    for n, gas in enumerate(GASES):
+        reading[gas + "_level"] = LEVELS[min(2, flags >> 2 * n & 3)]
+    return reading
+
+
+def _format(address, reading):
+    return ("%-18s #%3d  CO %5d (%s)  CH4 %5d (%s)  CO2 %5d (%s)  BAT %3d%%"
+            % (address, reading["counter"], reading["co"], reading["co_level"], reading["ch4"],
+               reading["ch4_level"], reading["co2"], reading["co2_level"], reading["batt"]))
+
+
+# Print every new frame heard for duration seconds
+async def scan(duration):
+    from bleak import BleakScanner  # only needed for scanning
+
+    last = {}
+
+    def detected(device, advertisement):
+        reading = decode(advertisement.manufacturer_data)
+        if reading is None or last.get(device.address) == reading["counter"]:
+            return
+        last[device.address] = reading["counter"]
+        print(_format(device.address, reading))
+
+    async with BleakScanner(detected):
+        await asyncio.sleep(duration)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Decode gas sensor broadcast frames")
+    parser.add_argument("payload", nargs="*", help="raw advertising payloads in hex")
+    parser.add_argument("--scan", type=float, metavar="SECONDS", help="listen for broadcasts")
+    args = parser.parse_args(argv)
+
+    if args.scan:
+        asyncio.run(scan(args.scan))
+        return
+    if not args.payload:
+        parser.error("give a payload or --scan SECONDS")
+    failed = False
+    for text in args.payload:
+        reading = decode(parse_payload(bytes.fromhex(text)).get(0xFF, b""))
+        if reading is None:
+            print("%s: no sensor frame" % text, file=sys.stderr)
+            failed = True
+        else:
+            print(_format("payload", reading))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
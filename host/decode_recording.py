@@ -0,0 +1,152 @@
+# Decode segment files written by recorder.py on the sensor board.
+#
+# Copy rec_*.bin and rec_*.idx off the board (e.g. `mpremote cp :rec_0.bin
+# :rec_0.idx .`), then:
+#   python decode_recording.py rec_*.bin -o readings.csv
+#   python decode_recording.py rec_*.bin --session 12 --start 3600 --end 7200
+# or from Python:
+#   from decode_recording import load
+#   data = load(["rec_0.bin", "rec_1.bin"])      # NumPy structured array
+#
+# The board's clock restarts at every reset, so timestamps only mean
+# something within one session (see recorder.py). Every record carries its
+# session number, sessions come out in the order they were recorded, and
+# --start/--end select a time range within each session.
+#
+# The layout is documented at the top of recorder.py; the constants below
+# must match it.
+
+import argparse
+import bisect
+import csv
+import os
+import struct
+import sys
+
+MAGIC = b"GREC"
+VERSION = 2
+HEADER = "<4sBBIH"
+RECORD = "<HHHHB"
+INDEX = "<HIH"
+FIELDS = ("session", "timestamp", "co", "ch4", "co2", "batt")
+
+
+def read_segment(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    header_size = struct.calcsize(HEADER)
+    magic, version, size, seq, session = struct.unpack_from(HEADER, data)
+    if magic != MAGIC or version != VERSION or size != struct.calcsize(RECORD):
+        raise ValueError("%s is not a recording segment" % path)
+    try:
+        with open(os.path.splitext(path)[0] + ".idx", "rb") as f:
+            index_data = f.read()
+    except FileNotFoundError:
+        index_data = b""
+    index_data = index_data[:len(index_data) - len(index_data) % struct.calcsize(INDEX)]
+    count = (len(data) - header_size) // size
+    return {
+        "seq": seq,
+        "index": list(struct.iter_unpack(INDEX, index_data)),
+        "records": memoryview(data)[header_size:header_size + count * size],
+        "count": count,
+    }
+
+
+# Sessions in the order they were recorded, each a list of blocks as
+# (first timestamp, raw record bytes). A session can span segments.
+def _sessions(paths):
+    segments = [read_segment(path) for path in paths]
+    segments.sort(key=lambda s: s["seq"])
+    size = struct.calcsize(RECORD)
+    sessions = []
+    current = None
+    for segment in segments:
+        index = segment["index"]
+        for i, (first, ts, session) in enumerate(index):
+            last = index[i + 1][0] if i + 1 < len(index) else segment["count"]
+            last = min(last, segment["count"])
+            if first >= last:
+                continue
+            if session != current:
+                sessions.append((session, []))
+                current = session
+            sessions[-1][1].append((ts, segment["records"][first * size:last * size]))
+    return sessions
+
+
+# Blocks of one session that may hold records between start and end. Block
+# timestamps only increase within a session, so the index is searched.
+def _blocks(blocks, start, end):
+    first = 0
+    if start is not None:
+        first = max(0, bisect.bisect_right([ts for ts, _ in blocks], start) - 1)
+    for ts, raw in blocks[first:]:
+        if end is not None and ts > end:
+            break
+        yield ts, raw
+
+
+def _selected(paths, session, start, end):
+    for number, blocks in _sessions(paths):
+        if session is None or number == session:
+            yield number, _blocks(blocks, start, end)
+
+
+# Yield (session, timestamp, co, ch4, co2, batt) tuples, session by session
+# and in time order within each
+def records(paths, start=None, end=None, session=None):
+    for number, blocks in _selected(paths, session, start, end):
+        for ts, raw in blocks:
+            for dt, co, ch4, co2, batt in struct.iter_unpack(RECORD, raw):
+                ts += dt
+                if (start is None or ts >= start) and (end is None or ts <= end):
+                    yield number, ts, co, ch4, co2, batt
+
+
+# All records as a NumPy structured array with FIELDS as field names
+def load(paths, start=None, end=None, session=None):
+    import numpy as np
+
+    record_dtype = np.dtype([("dt", "<u2"), ("co", "<u2"), ("ch4", "<u2"),
+                             ("co2", "<u2"), ("batt", "u1")])
+    out_dtype = np.dtype([("session", "<u2"), ("timestamp", "<i8"), ("co", "<u2"),
+                          ("ch4", "<u2"), ("co2", "<u2"), ("batt", "u1")])
+    parts = []
+    for number, blocks in _selected(paths, session, start, end):
+        for ts, raw in blocks:
+            rec = np.frombuffer(raw, dtype=record_dtype)
+            part = np.empty(len(rec), dtype=out_dtype)
+            part["session"] = number
+            part["timestamp"] = ts + np.cumsum(rec["dt"], dtype=np.int64)
+            for name in ("co", "ch4", "co2", "batt"):
+                part[name] = rec[name]
+            if start is not None:
+                part = part[part["timestamp"] >= start]
+            if end is not None:
+                part = part[part["timestamp"] <= end]
+            parts.append(part)
+    return np.concatenate(parts) if parts else np.empty(0, dtype=out_dtype)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Decode gas sensor recordings to CSV")
+    parser.add_argument("files", nargs="+", help="rec_*.bin segment files (with their .idx)")
+    parser.add_argument("-o", "--output", help="CSV file (default: stdout)")
+    parser.add_argument("--session", type=int, help="only this session")
+    parser.add_argument("--start", type=int, help="first timestamp (s) to include")
+    parser.add_argument("--end", type=int, help="last timestamp (s) to include")
+    args = parser.parse_args(argv)
+
+    out = open(args.output, "w", newline="") if args.output else sys.stdout
+    try:
+        writer = csv.writer(out)
+        writer.writerow(FIELDS)
+        writer.writerows(records(args.files, args.start, args.end, args.session))
+    finally:
+        if args.output:
+            out.close()
+
+
+if __name__ == "__main__":
+    main()
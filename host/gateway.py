@@ -0,0 +1,344 @@
+# Host-side collector for many "Gas Sensor" boards.
+#
+# Subscribes to the env_service characteristics of N devices at once, decodes
+# the payloads, and batches the readings into a local SQLite database.
+# Devices that drop are reconnected with exponential backoff.
+#
+# The BLE side is a pluggable transport:
+#   SimTransport    in-process fake peripherals that behave like main.py's
+#                   transmit_data, for load tests with hundreds of sensors
+#   BleakTransport  real devices through the bleak library (optional)
+#
+#   python gateway.py --sim 200 --duration 20
+#   python gateway.py --ble D8:3A:DD:73:5A:75 --db readings.db
+#
+# Ingest throughput and per-device end-to-end latency are reported when the
+# run ends. The combined measurement carries the device's timestamp, so its
+# latency runs from the sample being taken to the row being committed. The
+# device clock is mapped onto the host's with a per-link offset, the smallest
+# seen, so the figure excludes the fastest radio delay. The legacy payloads
+# carry no timestamp and are measured from their receipt.
+
+import argparse
+import asyncio
+import random
+import sqlite3
+import struct
+import time
+
+# Characteristic UUIDs of env_service (see main.py)
+CO_UUID = "ef090000-2ec0-4cd4-8f5a-51de99e65ecb"
+CH4_UUID = "ef090001-2ec0-4cd4-8f5a-51de99e65ecb"
+CO2_UUID = "ef090002-2ec0-4cd4-8f5a-51de99e65ecb"
+BATT_UUID = "ef090003-2ec0-4cd4-8f5a-51de99e65ecb"
+MEAS_UUID = "ef090005-2ec0-4cd4-8f5a-51de99e65ecb"
+
+LEGACY_CHANNELS = {CO_UUID: "co", CH4_UUID: "ch4", CO2_UUID: "co2", BATT_UUID: "batt"}
+# seq, timestamp ms, CO, CH4, CO2, battery, alarm flags. The timestamp is
+# time.ticks_ms() on the board, which wraps at 2**30 (about 12.4 days).
+MEAS_FORMAT = "<HIHHHBB"
+TICKS_PERIOD = 1 << 30
+
+
+# Readings carried by one notification as [(channel, value), ...]
+def decode(uuid, payload):
+    channel = LEGACY_CHANNELS.get(uuid)
+    if channel is not None:
+        return [(channel, struct.unpack("<H", payload)[0])]
+    if uuid == MEAS_UUID:
+        seq, ts, co, ch4, co2, batt, flags = struct.unpack(MEAS_FORMAT, payload)
+        return [("co", co), ("ch4", ch4), ("co2", co2), ("batt", batt), ("flags", flags)]
+    return []
+
+
+class SimTransport:
+    # packed: send the combined measurement instead of four <H notifications
+    # drop_rate: chance per cycle that a simulated link drops
+    def __init__(self, packed=False, period_ms=500, drop_rate=0.0, seed=None):
+        self.packed = packed
+        self.period_ms = period_ms
+        self.drop_rate = drop_rate
+        self._random = random.Random(seed)
+
+    async def connect(self, address, on_notify):
+        await asyncio.sleep(self._random.uniform(0.01, 0.05))
+        return _SimLink(self, address, on_notify)
+
+
+class _SimLink:
+    def __init__(self, transport, address, on_notify):
+        self._transport = transport
+        self._on_notify = on_notify
+        self._closed = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        t = self._transport
+        rnd = t._random
+        seq = 0
+        co, ch4, co2 = 0, 10, 424
+        try:
+            while True:
+                co = max(0, co + rnd.randint(-1, 1))
+                ch4 = max(0, ch4 + rnd.randint(-5, 5))
+                co2 = max(0, co2 + rnd.randint(-10, 10))
+                batt = 80
+                seq = (seq + 1) & 0xFFFF
+                if t.packed:
+                    payload = struct.pack(MEAS_FORMAT, seq, int(time.monotonic() * 1000) % TICKS_PERIOD,
+                                          co, ch4, co2, batt, 0)
+                    self._on_notify(MEAS_UUID, payload)
+                else:
+                    # Same cadence as the legacy transmit_data loop
+                    for uuid, value in ((CO_UUID, co), (CH4_UUID, ch4), (CO2_UUID, co2)):
+                        self._on_notify(uuid, struct.pack("<H", value))
+                        await asyncio.sleep(0.05)
+                    self._on_notify(BATT_UUID, struct.pack("<H", batt))
+                if rnd.random() < t.drop_rate:
+                    return
+                await asyncio.sleep(t.period_ms / 1000)
+        finally:
+            self._closed.set()
+
+    async def wait_disconnected(self):
+        await self._closed.wait()
+
+    async def close(self):
+        self._task.cancel()
+        await self._closed.wait()
+
+
+class BleakTransport:
+    def __init__(self, uuids=(MEAS_UUID,)):
+        import bleak  # only needed for real devices
+
+        self._bleak = bleak
+        self.uuids = uuids
+
+    async def connect(self, address, on_notify):
+        closed = asyncio.Event()
+        client = self._bleak.BleakClient(address, disconnected_callback=lambda c: closed.set())
+        await client.connect()
+        for uuid in self.uuids:
+            await client.start_notify(uuid, lambda ch, data, uuid=uuid: on_notify(uuid, bytes(data)))
+        return _BleakLink(client, closed)
+
+
+class _BleakLink:
+    def __init__(self, client, closed):
+        self._client = client
+        self._closed = closed
+
+    async def wait_disconnected(self):
+        await self._closed.wait()
+
+    async def close(self):
+        await self._client.disconnect()
+
+
+class SQLiteStore:
+    def __init__(self, path):
+        self._db = sqlite3.connect(path)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS readings "
+            "(device TEXT, received REAL, channel TEXT, value INTEGER)"
+        )
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+
+    # rows: [(device, received, channel, value), ...], received in Unix time
+    # (s)
+    def insert(self, rows):
+        self._db.executemany("INSERT INTO readings VALUES (?, ?, ?, ?)", rows)
+        self._db.commit()
+
+    def close(self):
+        self._db.close()
+
+
+class DeviceStats:
+    # Latencies are kept as a uniform random sample of at most reservoir
+    # values, so memory stays bounded however long the collector runs
+    def __init__(self, reservoir=1000, seed=None):
+        self.readings = 0
+        self.connects = 0
+        self.bad_payloads = 0
+        self.samples = 0
+        self.latencies = []
+        self._reservoir = reservoir
+        self._random = random.Random(seed)
+        self.new_link()
+
+    # The device may have reset, so its clock starts over
+    def new_link(self):
+        self._offset = None
+        self._last_ts = None
+        self._wraps = 0
+
+    # Host time (s) at which a sample stamped ts_ms by the device was taken
+    def sample_time(self, ts_ms, received):
+        ts_ms %= TICKS_PERIOD
+        if self._last_ts is not None and ts_ms < self._last_ts - TICKS_PERIOD // 2:
+            self._wraps += 1
+        self._last_ts = ts_ms
+        device_s = (ts_ms + self._wraps * TICKS_PERIOD) / 1000
+        offset = received - device_s
+        if self._offset is None or offset < self._offset:
+            self._offset = offset
+        return device_s + self._offset
+
+    def add_latency(self, latency):
+        self.samples += 1
+        if len(self.latencies) < self._reservoir:
+            self.latencies.append(latency)
+        else:
+            i = self._random.randrange(self.samples)
+            if i < self._reservoir:
+                self.latencies[i] = latency
+
+    def percentile(self, p):
+        if not self.latencies:
+            return 0.0
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))]
+
+
+class Collector:
+    def __init__(self, transport, store, batch_size=500, batch_ms=200,
+                 backoff_min=0.1, backoff_max=30.0):
+        self.transport = transport
+        self.store = store
+        self.batch_size = batch_size
+        self.batch_ms = batch_ms
+        self.backoff_min = backoff_min
+        self.backoff_max = backoff_max
+        self.stats = {}
+        self._pending = []
+        # (device, sample time) per notification, for the latencies
+        self._samples = []
+        self._wake = asyncio.Event()
+
+    def _on_notify(self, device, uuid, payload):
+        # Wall clock for the database, monotonic clock for the latencies
+        received = time.time()
+        arrived = time.monotonic()
+        stats = self.stats[device]
+        try:
+            readings = decode(uuid, payload)
+        except struct.error:
+            stats.bad_payloads += 1
+            return
+        if not readings:
+            return
+        taken = arrived
+        if uuid == MEAS_UUID:
+            taken = stats.sample_time(struct.unpack_from("<I", payload, 2)[0], arrived)
+        for channel, value in readings:
+            self._pending.append((device, received, channel, value))
+        self._samples.append((device, taken))
+        if len(self._pending) >= self.batch_size:
+            self._wake.set()
+
+    # Keep one device connected, reconnecting with exponential backoff
+    async def _device(self, address):
+        stats = self.stats.setdefault(address, DeviceStats())
+        backoff = self.backoff_min
+        while True:
+            try:
+                link = await self.transport.connect(
+                    address, lambda uuid, payload: self._on_notify(address, uuid, payload)
+                )
+            except Exception:
+                await asyncio.sleep(backoff * random.uniform(0.5, 1.0))
+                backoff = min(backoff * 2, self.backoff_max)
+                continue
+            stats.connects += 1
+            stats.new_link()
+            backoff = self.backoff_min
+            try:
+                await link.wait_disconnected()
+            finally:
+                await link.close()
+
+    def _flush(self):
+        rows = self._pending
+        if not rows:
+            return
+        samples = self._samples
+        self._pending = []
+        self._samples = []
+        self.store.insert(rows)
+        committed = time.monotonic()
+        for row in rows:
+            self.stats[row[0]].readings += 1
+        for device, taken in samples:
+            self.stats[device].add_latency(committed - taken)
+
+    async def _writer(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.batch_ms / 1000)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            self._flush()
+
+    async def run(self, addresses, duration=None):
+        tasks = [asyncio.create_task(self._device(a)) for a in addresses]
+        tasks.append(asyncio.create_task(self._writer()))
+        try:
+            if duration is None:
+                await asyncio.gather(*tasks)
+            else:
+                await asyncio.sleep(duration)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self._flush()
+
+    def report(self, elapsed):
+        total = sum(s.readings for s in self.stats.values())
+        print("devices: %d  readings: %d  throughput: %.0f readings/s"
+              % (len(self.stats), total, total / elapsed if elapsed else 0))
+        print("%-24s %8s %8s %6s %10s %10s"
+              % ("device", "readings", "connects", "bad", "p50 ms", "p99 ms"))
+        for address, s in sorted(self.stats.items()):
+            print("%-24s %8d %8d %6d %10.2f %10.2f"
+                  % (address, s.readings, s.connects, s.bad_payloads,
+                     s.percentile(50) * 1000, s.percentile(99) * 1000))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Collect readings from gas sensor boards")
+    parser.add_argument("--db", default="readings.db", help="SQLite database file")
+    parser.add_argument("--duration", type=float, help="stop after this many seconds")
+    parser.add_argument("--sim", type=int, metavar="N", help="use N simulated sensors")
+    parser.add_argument("--packed", action="store_true", help="simulated sensors send the combined measurement")
+    parser.add_argument("--drop-rate", type=float, default=0.0, help="simulated link drop chance per cycle")
+    parser.add_argument("--ble", nargs="*", metavar="ADDRESS", help="real devices to connect to")
+    args = parser.parse_args(argv)
+
+    if args.sim:
+        transport = SimTransport(packed=args.packed, drop_rate=args.drop_rate)
+        addresses = ["sim-%04d" % i for i in range(args.sim)]
+    elif args.ble:
+        transport = BleakTransport()
+        addresses = args.ble
+    else:
+        parser.error("give --sim N or --ble ADDRESS ...")
+
+    store = SQLiteStore(args.db)
+    collector = Collector(transport, store)
+    started = time.monotonic()
+    try:
+        asyncio.run(collector.run(addresses, args.duration))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        store.close()
+        collector.report(time.monotonic() - started)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+# Find the operations in firmware code that allocate on the MicroPython heap.
+#
+# CPython frees a loop's garbage as soon as its reference count drops, so
+# heap growth says nothing about the churn the same code causes on the
+# board. Instead, while an Audit is active every bytecode executed in a
+# firmware file is checked, and every builtin it calls:
+#   - opcodes that build a new object on MicroPython: f-strings and
+#     str formatting, list/tuple/dict/set displays, slices, closures and
+#     generator expressions
+#   - calls of builtins that return a new object (struct.pack, bytes, str,
+#     bytearray, memoryview, encode/decode, join, divmod, ...)
+#   - new generators and coroutines defined in firmware code, except those
+#     listed in allow (e.g. the one wait per sample every consumer makes)
+#   - new instances of firmware classes and namedtuples
+#   - floats and ints outside the 30-bit small int range, when they are
+#     assigned to a local or returned; MicroPython boxes both on the heap
+# Small int arithmetic, pack_into and writes into existing buffers are
+# free on MicroPython and are not reported. A float or big int that only
+# lives on the stack (e.g. passed straight to a call) is not seen, so keep
+# those out of the hot paths by review.
+#
+#   audit = Audit([firmware_dir], exclude=[host_dir])
+#   with audit:
+#       run_one_iteration()         # warm up: tasks already running are seen
+#   audit.clear()
+#   with audit:
+#       run_one_iteration()
+#   audit.found   ->  {"main.py:123 BUILD_STRING": 1, ...}
+
+import dis
+import os
+import sys
+
+_ALLOCATING_OPS = {
+    "FORMAT_VALUE", "BUILD_STRING", "BUILD_LIST", "BUILD_TUPLE", "BUILD_MAP",
+    "BUILD_CONST_KEY_MAP", "BUILD_SET", "BUILD_SLICE", "LIST_EXTEND", "SET_UPDATE",
+    "DICT_UPDATE", "DICT_MERGE", "MAKE_FUNCTION", "LIST_TO_TUPLE", "CALL_FUNCTION_EX",
+}
+_ALLOCATING_CALLS = {
+    "pack", "bytes", "bytearray", "str", "repr", "format", "list", "tuple", "dict",
+    "set", "sorted", "memoryview", "encode", "decode", "join", "split", "divmod",
+    "hex", "to_bytes", "from_bytes", "copy", "zip", "map", "filter", "enumerate",
+    "reversed", "float",
+}
+_GENERATOR_FLAGS = 0x20 | 0x80 | 0x200  # generator, coroutine, async generator
+_SMALL_INT = 1 << 30
+
+
+# What a value costs on the MicroPython heap, None if nothing
+def _boxed(value):
+    kind = type(value)
+    if kind is float:
+        return "float"
+    if kind is int and not -_SMALL_INT <= value < _SMALL_INT:
+        return "bigint"
+    return None
+
+
+class Audit:
+    # roots: directories whose .py files count as firmware, minus exclude
+    # allow: qualified names of firmware coroutines that may be created
+    def __init__(self, roots, exclude=(), allow=()):
+        self.roots = tuple(os.path.abspath(root) + os.sep for root in roots)
+        self.exclude = tuple(os.path.abspath(path) + os.sep for path in exclude)
+        self.allow = set(allow)
+        self.found = {}
+        self._firmware = {}
+        # Generator frames seen, kept alive so that their ids stay unique
+        self._frames = {}
+        # Per frame being traced: (line, ids of the boxed locals)
+        self._locals = {}
+
+    def _is_firmware(self, code):
+        name = code.co_filename
+        known = self._firmware.get(name)
+        if known is None:
+            path = os.path.abspath(name)
+            known = path.startswith(self.roots) and not path.startswith(self.exclude)
+            self._firmware[name] = known
+        return known
+
+    def _report(self, frame, what):
+        key = "%s:%d %s" % (os.path.basename(frame.f_code.co_filename), frame.f_lineno, what)
+        self.found[key] = self.found.get(key, 0) + 1
+
+    # Report the locals that became a float or big int since the last line
+    def _check_locals(self, frame, report=True):
+        line, seen = self._locals.get(frame, (frame.f_lineno, {}))
+        now = {}
+        for name, value in frame.f_locals.items():
+            boxed = _boxed(value)
+            if boxed is not None:
+                now[name] = id(value)
+                if report and seen.get(name) != id(value):
+                    key = "%s:%d %s %s" % (os.path.basename(frame.f_code.co_filename), line, boxed, name)
+                    self.found[key] = self.found.get(key, 0) + 1
+        self._locals[frame] = (frame.f_lineno, now)
+
+    def _trace(self, frame, event, arg):
+        code = frame.f_code
+        if event == "call":
+            # A new instance, reported where it is created. The __new__ of
+            # a namedtuple is generated in a module named after it.
+            module = frame.f_globals.get("__name__", "")
+            if module.startswith("namedtuple_"):
+                created = module[11:]
+            elif code.co_name == "__init__" and self._is_firmware(code):
+                created = code.co_qualname.rsplit(".", 1)[0]
+            else:
+                created = None
+            caller = frame.f_back
+            if created and caller is not None and self._is_firmware(caller.f_code):
+                self._report(caller, "new " + created)
+        if not self._is_firmware(code):
+            return None
+        frame.f_trace_opcodes = True
+        if event == "call":
+            if code.co_flags & _GENERATOR_FLAGS:
+                # The first resume of a generator is its creation
+                if id(frame) not in self._frames:
+                    self._frames[id(frame)] = frame
+                    if code.co_qualname not in self.allow:
+                        self._report(frame, "new " + code.co_qualname)
+            if frame not in self._locals:
+                # Arguments were paid for by the caller
+                self._check_locals(frame, report=False)
+        elif event == "line":
+            self._check_locals(frame)
+        elif event == "return":
+            self._check_locals(frame)
+            boxed = _boxed(arg)
+            if boxed is not None:
+                self._report(frame, boxed + " return")
+            if not code.co_flags & _GENERATOR_FLAGS:
+                self._locals.pop(frame, None)
+        elif event == "opcode":
+            op = dis.opname[code.co_code[frame.f_lasti]]
+            if op in _ALLOCATING_OPS:
+                self._report(frame, op)
+        return self._trace
+
+    def _profile(self, frame, event, arg):
+        if event == "c_call" and self._is_firmware(frame.f_code):
+            name = getattr(arg, "__name__", "")
+            if name in _ALLOCATING_CALLS:
+                self._report(frame, name + "()")
+
+    def __enter__(self):
+        sys.settrace(self._trace)
+        sys.setprofile(self._profile)
+        return self
+
+    def __exit__(self, *args):
+        sys.settrace(None)
+        sys.setprofile(None)
+
+    def clear(self):
+        self.found = {}
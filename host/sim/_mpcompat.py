@@ -0,0 +1,79 @@
+# Adds the MicroPython-only functions to CPython's time and gc modules:
+# time.ticks_ms, ticks_us, ticks_diff, ticks_add, sleep_ms, sleep_us, and
+# gc.mem_free, gc.mem_alloc. Ticks wrap at 2**30 like on the RP2040 port,
+# time.time() returns an int like MicroPython, and the heap figures pretend
+# to be a 192 kB MicroPython heap (the Pico W's, give or take).
+#
+# set_clock(fn) replaces the time source (fn returns nanoseconds), so
+# benchmarks can run on a simulated clock.
+
+import gc
+import sys
+import time
+
+_PERIOD = 1 << 30
+_MASK = _PERIOD - 1
+
+_clock = time.monotonic_ns
+_origin = _clock()
+_time = time.time
+
+
+def set_clock(fn):
+    global _clock, _origin
+    _clock = fn
+    _origin = fn()
+
+
+def ticks_ms():
+    return ((_clock() - _origin) // 1_000_000) & _MASK
+
+
+def ticks_us():
+    return ((_clock() - _origin) // 1_000) & _MASK
+
+
+def ticks_cpu():
+    return (_clock() - _origin) & _MASK
+
+
+def ticks_diff(a, b):
+    d = (a - b) & _MASK
+    return d - _PERIOD if d & (_PERIOD >> 1) else d
+
+
+def ticks_add(a, b):
+    return (a + b) & _MASK
+
+
+def sleep_ms(ms):
+    time.sleep(ms / 1000)
+
+
+def sleep_us(us):
+    time.sleep(us / 1_000_000)
+
+
+def _int_time():
+    return int(_time())
+
+
+for _name in ("ticks_ms", "ticks_us", "ticks_cpu", "ticks_diff", "ticks_add", "sleep_ms", "sleep_us"):
+    setattr(time, _name, globals()[_name])
+time.time = _int_time
+
+HEAP_SIZE = 192 * 1024
+# Blocks already in use when the firmware starts are not counted
+_base_blocks = sys.getallocatedblocks()
+
+
+def mem_alloc():
+    return max(0, min(HEAP_SIZE, (sys.getallocatedblocks() - _base_blocks) * 16))
+
+
+def mem_free():
+    return HEAP_SIZE - mem_alloc()
+
+
+gc.mem_alloc = mem_alloc
+gc.mem_free = mem_free
@@ -0,0 +1,154 @@
+# Stand-in for aioble under CPython.
+#
+# Nothing goes over the air: advertise() hands out connections queued by the
+# test or benchmark with add_central(), notifications and indications are
+# recorded on the characteristic, and a central's writes are injected with
+# Central.write().
+#
+#   central = aioble.add_central()
+#   central.write(main.recv_characteristic, b"hello")
+#   main.measurement_characteristic.notifications[-1]
+
+import asyncio
+
+# Every advertise() call: (interval_us, name, kwargs)
+adverts = []
+_pending = []
+_arrived = None
+
+
+def _event():
+    global _arrived
+    if _arrived is None:
+        _arrived = asyncio.Event()
+    return _arrived
+
+
+class Device:
+    def __init__(self, addr):
+        self.addr = addr
+
+    def __repr__(self):
+        return "Device(%s)" % self.addr
+
+
+class DeviceConnection:
+    _count = 0
+
+    def __init__(self, device=None, mtu=None):
+        DeviceConnection._count += 1
+        self.device = device or Device("central-%d" % DeviceConnection._count)
+        self.mtu = mtu
+        self._connected = True
+        self._closed = asyncio.Event()
+
+    def is_connected(self):
+        return self._connected
+
+    async def disconnected(self, timeout_ms=None):
+        if timeout_ms is None:
+            await self._closed.wait()
+        else:
+            await asyncio.wait_for(self._closed.wait(), timeout_ms / 1000)
+
+    async def disconnect(self, timeout_ms=2000):
+        self._connected = False
+        self._closed.set()
+
+    async def exchange_mtu(self, mtu=None):
+        self.mtu = mtu
+        return mtu
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.disconnect()
+
+
+# A simulated central: connects at the next advertise(), writes to
+# characteristics and drops the link
+class Central(DeviceConnection):
+    def write(self, characteristic, data):
+        characteristic._written(self, bytes(data))
+
+    def drop(self):
+        self._connected = False
+        self._closed.set()
+
+
+def add_central(mtu=None):
+    central = Central(mtu=mtu)
+    _pending.append(central)
+    _event().set()
+    return central
+
+
+class Service:
+    def __init__(self, uuid):
+        self.uuid = uuid
+        self.characteristics = []
+
+
+class Characteristic:
+    def __init__(self, service, uuid, read=False, write=False, write_no_response=False,
+                 notify=False, indicate=False, initial=None, capture=False):
+        service.characteristics.append(self)
+        self.uuid = uuid
+        self.capture = capture
+        self._value = bytes(initial or b"")
+        # (connection, data) of every notification and indication sent
+        self.notifications = []
+        # Number of write() calls, to see how often the value is refreshed
+        self.writes = 0
+        self._queue = asyncio.Queue()
+
+    def read(self):
+        return self._value
+
+    def write(self, data, send_update=False):
+        self._value = bytes(data)
+        self.writes += 1
+
+    def notify(self, connection, data=None):
+        if not connection.is_connected():
+            raise OSError(128)
+        self.notifications.append((connection, bytes(self._value if data is None else data)))
+
+    async def indicate(self, connection, data=None, timeout_ms=1000):
+        self.notify(connection, data)
+
+    def _written(self, connection, data):
+        self._value = data
+        self._queue.put_nowait((connection, data) if self.capture else connection)
+
+    async def written(self, timeout_ms=None):
+        if timeout_ms is None:
+            return await self._queue.get()
+        return await asyncio.wait_for(self._queue.get(), timeout_ms / 1000)
+
+
+def register_services(*services):
+    pass
+
+
+def stop():
+    pass
+
+
+# Returns the next central added with add_central(), or raises
+# asyncio.TimeoutError after timeout_ms like the real one
+async def advertise(interval_us, adv_data=None, resp_data=None, connect=True,
+                    limited_disc=False, br_edr=False, name=None, services=None,
+                    appearance=0, manufacturer=None, timeout_ms=None):
+    adverts.append((interval_us, name, {"services": services, "appearance": appearance,
+                                        "manufacturer": manufacturer, "connect": connect,
+                                        "timeout_ms": timeout_ms}))
+    event = _event()
+    while not _pending:
+        event.clear()
+        if timeout_ms is None:
+            await event.wait()
+        else:
+            await asyncio.wait_for(event.wait(), timeout_ms / 1000)
+    return _pending.pop(0)
@@ -0,0 +1,65 @@
+# Stand-in for the MicroPython "bluetooth" module under CPython, enough for
+# aioble (see aioble/) and ble_advertising.py.
+
+import uuid as _uuid
+
+FLAG_READ = 0x0002
+FLAG_WRITE_NO_RESPONSE = 0x0004
+FLAG_WRITE = 0x0008
+FLAG_NOTIFY = 0x0010
+FLAG_INDICATE = 0x0020
+
+
+class UUID:
+    def __init__(self, value):
+        if isinstance(value, int):
+            self._bytes = value.to_bytes(2, "little")
+        elif isinstance(value, str):
+            self._bytes = _uuid.UUID(value).bytes[::-1]
+        else:
+            self._bytes = bytes(value)
+
+    def __bytes__(self):
+        return self._bytes
+
+    def __len__(self):
+        return len(self._bytes)
+
+    def __eq__(self, other):
+        return isinstance(other, UUID) and self._bytes == other._bytes
+
+    def __hash__(self):
+        return hash(self._bytes)
+
+    def __repr__(self):
+        if len(self._bytes) == 2:
+            return "UUID(0x%04x)" % int.from_bytes(self._bytes, "little")
+        return "UUID('%s')" % _uuid.UUID(bytes=self._bytes[::-1])
+
+
+class BLE:
+    _instance = None
+
+    def __new__(cls):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+            cls._instance._active = False
+            cls._instance.adverts = []
+        return cls._instance
+
+    def active(self, state=None):
+        if state is not None:
+            self._active = bool(state)
+        return self._active
+
+    def config(self, *args, **kwargs):
+        if args == ("mac",):
+            return (0, b"\xd8\x3a\xdd\x73\x5a\x75")
+        return None
+
+    def irq(self, handler):
+        pass
+
+    # Every advertising (re)start: (interval_us, adv_data, connectable)
+    def gap_advertise(self, interval_us, adv_data=None, resp_data=None, connectable=True):
+        self.adverts.append((interval_us, bytes(adv_data or b""), connectable))
@@ -0,0 +1,207 @@
+# Stand-in for the MicroPython "machine" module under CPython.
+#
+# ADC channels read from scripted or recorded waveforms, and I2C buses count
+# their transactions and bytes instead of talking to hardware:
+#
+#   machine.set_waveform(28, sine(20000, 5000, 200))   # GPIO28 / MQ-4
+#   machine.set_waveform(26, load_waveform("mq135.txt"))
+#   bus = RGB1602.RGB1602_I2C; bus.transactions, bus.bytes_written
+
+import _mpcompat  # noqa: F401
+import math
+
+# ADC channel of each analog GPIO (GPIO26..29 -> 0..3)
+_ADC_CHANNEL = {26: 0, 27: 1, 28: 2, 29: 3}
+_waveforms = {}
+# Reading of a channel without a waveform
+DEFAULT_ADC = 800
+
+
+# Feed an ADC channel (pin number or channel) from values, a sequence that is
+# repeated or a function of the read index
+def set_waveform(pin, values):
+    _waveforms[_ADC_CHANNEL.get(pin, pin)] = [values, 0]
+
+
+def clear_waveforms():
+    _waveforms.clear()
+
+
+def constant(value):
+    return lambda n: value
+
+
+def sine(mean, amplitude, period, noise=0, seed=1):
+    import random
+
+    rnd = random.Random(seed)
+    return lambda n: mean + amplitude * math.sin(2 * math.pi * n / period) + rnd.uniform(-noise, noise)
+
+
+def step(before, after, at):
+    return lambda n: before if n < at else after
+
+
+# One raw reading per line, e.g. dumped from the board with testing.py
+def load_waveform(path):
+    with open(path) as f:
+        return [int(float(line)) for line in f if line.strip()]
+
+
+class Pin:
+    IN = 0
+    OUT = 1
+    OPEN_DRAIN = 2
+    ALT = 3
+    PULL_UP = 1
+    PULL_DOWN = 2
+    IRQ_RISING = 4
+    IRQ_FALLING = 8
+
+    def __init__(self, id, mode=-1, pull=-1, value=None, alt=-1):
+        self.id = id
+        self._value = value or 0
+
+    def init(self, *args, **kwargs):
+        pass
+
+    def value(self, value=None):
+        if value is None:
+            return self._value
+        self._value = value
+
+    def on(self):
+        self._value = 1
+
+    def off(self):
+        self._value = 0
+
+    def irq(self, handler=None, trigger=0):
+        pass
+
+
+class ADC:
+    CORE_TEMP = 4
+
+    def __init__(self, pin):
+        pin = pin.id if isinstance(pin, Pin) else pin
+        self.channel = _ADC_CHANNEL.get(pin, pin)
+        self.reads = 0
+
+    def read_u16(self):
+        self.reads += 1
+        source = _waveforms.get(self.channel)
+        if source is None:
+            return DEFAULT_ADC
+        values, n = source
+        source[1] = n + 1
+        value = values(n) if callable(values) else values[n % len(values)]
+        return max(0, min(65535, int(value)))
+
+
+class I2C:
+    def __init__(self, id=0, scl=None, sda=None, freq=400_000):
+        self.id = id
+        self.freq = freq
+        self.transactions = 0
+        self.bytes_written = 0
+        # Raise this error from the next transaction, to test recovery
+        self.fail_next = None
+        self.devices = [0x3E, 0x60]
+
+    def reset_counters(self):
+        self.transactions = 0
+        self.bytes_written = 0
+
+    def _transfer(self, nbytes):
+        if self.fail_next is not None:
+            error, self.fail_next = self.fail_next, None
+            raise error
+        self.transactions += 1
+        self.bytes_written += nbytes
+
+    # Address byte, register byte and the data
+    def writeto_mem(self, addr, memaddr, buf, addrsize=8):
+        self._transfer(2 + len(buf))
+
+    def writeto(self, addr, buf, stop=True):
+        self._transfer(1 + len(buf))
+
+    def readfrom_mem(self, addr, memaddr, nbytes, addrsize=8):
+        self._transfer(2)
+        return bytes(nbytes)
+
+    def readfrom(self, addr, nbytes, stop=True):
+        self._transfer(1)
+        return bytes(nbytes)
+
+    def scan(self):
+        return list(self.devices)
+
+
+class WDT:
+    def __init__(self, id=0, timeout=5000):
+        self.timeout = timeout
+        self.feeds = 0
+
+    def feed(self):
+        self.feeds += 1
+
+
+class _Mem:
+    def __init__(self, mask):
+        self._mask = mask
+        self._words = {}
+
+    def __getitem__(self, addr):
+        return self._words.get(addr, 0)
+
+    def __setitem__(self, addr, value):
+        self._words[addr] = value & self._mask
+
+
+mem8 = _Mem(0xFF)
+mem16 = _Mem(0xFFFF)
+mem32 = _Mem(0xFFFFFFFF)
+
+# Time spent in lightsleep, so power experiments can be checked
+slept_ms = 0
+
+
+def lightsleep(ms=None):
+    global slept_ms
+    slept_ms += ms or 0
+
+
+deepsleep = lightsleep
+
+
+def freq(hz=None):
+    return 125_000_000
+
+
+def unique_id():
+    return b"\xe6\x61\x41\x04\x03\x2a\x5a\x75"
+
+
+class ResetError(SystemExit):
+    pass
+
+
+def reset():
+    raise ResetError("machine.reset()")
+
+
+soft_reset = reset
+
+
+def reset_cause():
+    return 1
+
+
+def disable_irq():
+    return 0
+
+
+def enable_irq(state=0):
+    pass
@@ -0,0 +1,34 @@
+# Stand-in for the MicroPython "micropython" module under CPython.
+
+import _mpcompat  # noqa: F401
+
+
+def const(value):
+    return value
+
+
+def native(f):
+    return f
+
+
+viper = native
+
+
+def mem_info(*args):
+    pass
+
+
+def heap_lock():
+    pass
+
+
+def heap_unlock():
+    pass
+
+
+def alloc_emergency_exception_buf(size):
+    pass
+
+
+def schedule(func, arg):
+    func(arg)
@@ -0,0 +1,16 @@
+# Stand-in for uasyncio: CPython's asyncio plus sleep_ms. Importing either
+# name gives the same module, so "import uasyncio as asyncio" in the firmware
+# and "import asyncio" in host code share one event loop.
+
+import asyncio
+import sys
+
+import _mpcompat  # noqa: F401
+
+
+async def sleep_ms(ms):
+    await asyncio.sleep(ms / 1000)
+
+
+asyncio.sleep_ms = sleep_ms
+sys.modules["uasyncio"] = asyncio
@@ -0,0 +1,134 @@
+# The sampling, display and notification loops must not allocate on the
+# MicroPython heap once running. Run from host/:
+#
+#   python -m unittest test_heap
+#
+# See heapaudit.py for what counts as an allocation.
+
+import asyncio
+import os
+import tempfile
+import unittest
+
+import bench
+from heapaudit import Audit
+
+
+class AuditTest(unittest.TestCase):
+    # The audit must catch what the loops used to do
+    def test_finds_allocations(self):
+        with tempfile.TemporaryDirectory() as root:
+            source = (
+                "import struct\n"
+                "from collections import namedtuple\n"
+                "Pair = namedtuple('Pair', ('a', 'b'))\n"
+                "class Box:\n"
+                "    def __init__(self):\n"
+                "        self.a = 0\n"
+                "def half(v):\n"
+                "    return v * 0.5\n"
+                "def work(buf, values):\n"
+                "    line = f'CO:{values[0]}'\n"
+                "    data = struct.pack('<H', values[1])\n"
+                "    alert = any(v > 10 for v in values)\n"
+                "    view = buf[1:3]\n"
+                "    struct.pack_into('<H', buf, 0, values[0] + 1)\n"
+                "    pair = Pair(values[0], values[1])\n"
+                "    box = Box()\n"
+                "    wide = values[0] ^ 0x5A5A5A5A\n"
+                "    narrow = values[0] ^ 0x1A5A\n"
+                "    return half(narrow)\n"
+            )
+            namespace = {}
+            exec(compile(source, os.path.join(root, "fw.py"), "exec"), namespace)
+            audit = Audit([root])
+            with audit:
+                namespace["work"](bytearray(4), [1, 2, 30])
+        found = " ".join(audit.found)
+        for what in ("fw.py:10 BUILD_STRING", "fw.py:11 pack()", "fw.py:12 new work.<locals>.<genexpr>",
+                     "fw.py:13 BUILD_SLICE", "fw.py:15 new Pair", "fw.py:16 new Box",
+                     "fw.py:17 bigint wide", "fw.py:8 float return"):
+            self.assertIn(what, found)
+        for line in ("fw.py:14", "fw.py:18"):
+            self.assertNotIn(line, found)
+
+
+# The loops are audited in one event loop (the firmware's events bind to
+# the first loop that uses them); the tests check the findings
+class LoopsTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as workdir:
+            main = bench._import_main(workdir)
+            try:
+                cls.found = asyncio.run(cls._run(main))
+            finally:
+                os.chdir(cwd)
+
+    @staticmethod
+    async def _run(main):
+        found = {}
+        # The sampler itself (ADC bursts, tables, alarm engine) and the
+        # snapshot kept for a reset
+        task = await bench._run_task(main.retain_task())
+        for scenario in bench.SCENARIOS:
+            found["sample", scenario] = await bench.audit(main, scenario)
+        await bench._stop(task)
+
+        await main.LCD.begin()
+        display = await bench._run_task(main.LCD.run())
+
+        task = await bench._run_task(main.lcd_task())
+        for scenario in bench.SCENARIOS:
+            found["lcd", scenario] = await bench.audit(main, scenario)
+        await bench._stop(task)
+
+        central = bench.aioble.add_central()
+        main.connections.open(central)
+        task = await bench._run_task(main.transmit_data())
+        for scenario in bench.SCENARIOS:
+            found["transmit", scenario] = await bench.audit(main, scenario)
+        await bench._stop(task)
+        central.drop()
+        await main.connections.close(central)
+
+        # Alert and dimmed refreshes take other backlight paths
+        audit = Audit([os.path.dirname(bench.HOST)], exclude=[bench.HOST])
+        for name, level, brightness in (("alert", main.alarms.ALERT, 255),
+                                        ("dimmed", main.alarms.NORMAL, 40)):
+            with audit:
+                main.write_to_LCD(main._lcd_line1, main._lcd_line2, level, brightness)
+                await bench._settle()
+            audit.clear()
+            with audit:
+                for _ in range(5):
+                    main.write_to_LCD(main._lcd_line1, main._lcd_line2, level, brightness)
+                    await bench._settle()
+            found["backlight", name] = audit.found
+            audit.clear()
+
+        await bench._stop(display)
+        return found
+
+    def _check(self, path):
+        for (name, case), found in self.found.items():
+            if name == path:
+                with self.subTest(case=case):
+                    self.assertEqual(found, {})
+
+    def test_sample(self):
+        self._check("sample")
+
+    def test_lcd(self):
+        self._check("lcd")
+
+    def test_transmit(self):
+        self._check("transmit")
+
+    def test_backlight(self):
+        self._check("backlight")
+
+
+if __name__ == "__main__":
+    unittest.main()
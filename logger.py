@@ -0,0 +1,123 @@
+# Buffered, size-capped log writer.
+#
+# Lines are printed and, when file logging is on, collected in a RAM buffer
+# that is written to flash one block at a time (or by the flush task after
+# flush_ms), instead of a flash write per line. The log rotates across
+# max_files files of at most max_file_size bytes, so flash use is bounded.
+# Messages below the current level return before any string formatting.
+
+from micropython import const
+import os
+import uasyncio as asyncio
+
+DEBUG = const(10)
+INFO = const(20)
+WARNING = const(30)
+ERROR = const(40)
+
+_PREFIX = {DEBUG: "D ", INFO: "I ", WARNING: "W ", ERROR: "E "}
+
+
+class Logger:
+    # path: current log file, older ones are path with .1, .2, ... inserted
+    # before the extension (log.txt -> log.1.txt)
+    def __init__(self, path="log.txt", level=INFO, to_file=False, echo=True,
+                 block_size=4096, max_file_size=65536, max_files=4,
+                 flush_ms=10_000):
+        self.level = level
+        self.to_file = to_file
+        self.echo = echo
+        self.max_file_size = max_file_size
+        self.max_files = max_files
+        self.flush_ms = flush_ms
+        self._path = path
+        dot = path.rfind(".")
+        self._stem = path[:dot] if dot > 0 else path
+        self._ext = path[dot:] if dot > 0 else ""
+        self._buf = bytearray(block_size)
+        self._len = 0
+        try:
+            self._file_size = os.stat(path)[6]
+        except OSError:
+            self._file_size = 0
+        # Number of flash writes, to check the batching works
+        self.writes = 0
+
+    def enabled(self, level):
+        return level >= self.level
+
+    def log(self, level, *args):
+        if level < self.level:
+            return
+        data = " ".join(str(arg) for arg in args)
+        if self.echo:
+            print(data)
+        if self.to_file:
+            self._append(_PREFIX.get(level, "") + data + "\n")
+
+    def debug(self, *args):
+        if DEBUG >= self.level:
+            self.log(DEBUG, *args)
+
+    def info(self, *args):
+        if INFO >= self.level:
+            self.log(INFO, *args)
+
+    def warning(self, *args):
+        if WARNING >= self.level:
+            self.log(WARNING, *args)
+
+    def error(self, *args):
+        if ERROR >= self.level:
+            self.log(ERROR, *args)
+
+    def _append(self, line):
+        data = line.encode()
+        if self._len + len(data) > len(self._buf):
+            self.flush()
+        if len(data) > len(self._buf):
+            # Longer than a whole block, write it straight through
+            self._write(data)
+            return
+        self._buf[self._len:self._len + len(data)] = data
+        self._len += len(data)
+
+    def flush(self):
+        if self._len:
+            self._write(memoryview(self._buf)[:self._len])
+            self._len = 0
+
+    def _write(self, data):
+        if self._file_size + len(data) > self.max_file_size:
+            self._rotate()
+        with open(self._path, "ab") as f:
+            f.write(data)
+        self._file_size += len(data)
+        self.writes += 1
+
+    def _name(self, n):
+        return self._path if n == 0 else self._stem + "." + str(n) + self._ext
+
+    def _rotate(self):
+        try:
+            os.remove(self._name(self.max_files - 1))
+        except OSError:
+            pass
+        for n in range(self.max_files - 1, 0, -1):
+            try:
+                os.rename(self._name(n - 1), self._name(n))
+            except OSError:
+                pass
+        self._file_size = 0
+
+    # Record an exception and get everything onto flash, used right before a
+    # reset
+    def crash(self, *args):
+        self.log(ERROR, *args)
+        self.flush()
+
+    # Flush whatever is buffered every flush_ms
+    async def run(self):
+        while True:
+            await asyncio.sleep_ms(self.flush_ms)
+            self.flush()
@@ -6,21 +6,54 @@ from micropython import const
 import uasyncio as asyncio
 import aioble
 import bluetooth
-from machine import Pin, ADC, reset
+from machine import Pin, ADC, reset, lightsleep
 import math
-import RGB1602
+import aiorgb1602
+from adcfilter import BurstADC, REDUCE_TRIMMED
+from sampler import Sampler
+from battery import BatteryMonitor
+from gaslut import GasLUT, cached_lut
+import calibration
+from supervisor import MAX_BLOCK_MS, Supervisor
+import retained
+from history import History, TIER_HOUR
+from recorder import Recorder
+import time
+from notify_policy import NotifyPolicy
+from connections import ConnectionManager
 import struct
+import gc
+from array import array
+import logger
+from textfmt import put_bytes, put_int, pad
+from profiler import Profiler, LAG_BUCKETS
+import alarms
+from alarms import AlarmEngine
+from power import EnergyModel, PowerManager
+from ble_advertising import advertising_payload, MANUFACTURER_OFFSET
+from advertiser import AdvertisingScheduler
+import config
 
 # Enables logging to log.txt in root directory of Pico W
-# For testing/debugging purposes only, will eventually fill the board's 2 MB flash memory
+# Writes are batched in 4 kB blocks and rotated across 4 files of 64 kB
 ENABLE_LOGGING = const(False)
 
+# Times the hot paths and the event loop lag for the diagnostics
+# characteristic. When False the probes compile away entirely.
+ENABLE_PROFILING = const(False)
+
 # GPIO Pins used for sensors
 # LCD: SDA is on GPIO4, and SCL is on GPIO5
-MQ_4 = ADC(Pin(28))
-MQ_7 = ADC(Pin(27))
-MQ_135 = ADC(Pin(26))
-LCD = RGB1602.RGB1602(16, 2)
+# Each reading is a trimmed mean of a burst of 8 conversions followed by an
+# EMA (weight 1/2) to tame the RP2040 ADC noise
+_MQ_4_ADC = ADC(Pin(28))
+_MQ_7_ADC = ADC(Pin(27))
+_MQ_135_ADC = ADC(Pin(26))
+MQ_4 = BurstADC(_MQ_4_ADC, 8, REDUCE_TRIMMED, trim=2, ema_shift=1)
+MQ_7 = BurstADC(_MQ_7_ADC, 8, REDUCE_TRIMMED, trim=2, ema_shift=1)
+MQ_135 = BurstADC(_MQ_135_ADC, 8, REDUCE_TRIMMED, trim=2, ema_shift=1)
+# LCD operations are queued and performed by the LCD.run() task
+LCD = aiorgb1602.AsyncRGB1602(16, 2)
 
 # Voltage Divider (used to convert sensor output from 5V to 3.3V)
 # 1000 / (470 + 1000)
@@ -28,10 +61,21 @@ V_DIV = const(0.680272108843537)
 
 # Parameters derived from calibration data
 # -----------------------------------------
-# Clean Air Ro values
-MQ_4_RO = 94.94876
-MQ_7_RO = 89.80074
-MQ_135_RO = 73.23104
+# Clean Air Ro values, superseded by the last on-device calibration (the
+# "CAL" command) saved in calib.json
+_CALIB_FILE = "calib.json"
+_calib = calibration.load(_CALIB_FILE)
+
+def _calibrated(name, default):
+    try:
+        Ro = float(_calib[name])
+    except (KeyError, TypeError, ValueError):
+        return default
+    return Ro if Ro > 0 else default
+
+MQ_4_RO = _calibrated("mq4", 94.94876)
+MQ_7_RO = _calibrated("mq7", 89.80074)
+MQ_135_RO = _calibrated("mq135", 73.23104)
 # -----------------------------------------
 # Slope/intercept points for log(y) = m*log(x) + b
 # where y = Rs / Ro, x = ppm
@@ -55,14 +99,30 @@ _ENV_SENSE_CO2_UUID = bluetooth.UUID("ef090002-2ec0-4cd4-8f5a-51de99e65ecb")
 _ENV_SENSE_BATT_UUID = bluetooth.UUID("ef090003-2ec0-4cd4-8f5a-51de99e65ecb")
 # Data Receiving
 _ENV_SENSE_RECV_UUID = bluetooth.UUID("ef090004-2ec0-4cd4-8f5a-51de99e65ecb")
+# Combined measurement, one notification per sample
+_ENV_SENSE_MEAS_UUID = bluetooth.UUID("ef090005-2ec0-4cd4-8f5a-51de99e65ecb")
+# History download
+_ENV_SENSE_HIST_UUID = bluetooth.UUID("ef090006-2ec0-4cd4-8f5a-51de99e65ecb")
+# Diagnostics (profiler, heap and I2C figures)
+_ENV_SENSE_DIAG_UUID = bluetooth.UUID("ef090007-2ec0-4cd4-8f5a-51de99e65ecb")
 # org.bluetooth.characteristic.gap.appearance.xml
 _ADV_APPEARANCE_GENERIC_SENSOR = const(0x0540)
 # How frequently to send advertising beacons in microseconds
 _ADV_INTERVAL_US = const(250_000)
+# Interval once the readings are stable (power saving)
+_ADV_STABLE_INTERVAL_US = const(1_000_000)
+# Advertising is restarted this often to pick up a new interval
+_ADV_SLICE_MS = const(30_000)
+# Advertised name per alarm level (normal, warning, alert), so scanners can
+# pick out a device in alert without connecting
+_ADV_NAMES = ("Gas Sensor", "Gas Sensor WARN", "Gas Sensor ALERT")
+# Fast advertising after an alarm rises or a central disconnects, as
+# (interval us, duration ms) steps backing off to the idle interval
+_ADV_BURST_STEPS = ((20_000, 30_000), (100_000, 30_000), (250_000, 60_000))
+# Number of centrals (e.g. phone and gateway) that can be connected at once
+_MAX_CONNECTIONS = const(2)
 # Pico W MAC Address
 # D8:3A:DD:73:5A:75
-# Global Battery Percent Variable
-batt_avg = 0
 
 # Register GATT server.
 env_service = aioble.Service(_ENV_SENSE_UUID)
@@ -81,49 +141,195 @@ batt_characteristic = aioble.Characteristic(
 recv_characteristic = aioble.Characteristic(
     env_service, _ENV_SENSE_RECV_UUID, write=True, read=True, notify=True, capture=True
 )
+measurement_characteristic = aioble.Characteristic(
+    env_service, _ENV_SENSE_MEAS_UUID, read=True, notify=True
+)
+history_characteristic = aioble.Characteristic(
+    env_service, _ENV_SENSE_HIST_UUID, write=True, notify=True, capture=True
+)
+diagnostics_characteristic = aioble.Characteristic(
+    env_service, _ENV_SENSE_DIAG_UUID, read=True
+)
 aioble.register_services(env_service)
 
-if ENABLE_LOGGING:
-    log_file = open('log.txt', 'a')
-
-def _logger(*args, **kwargs):
-    data = ' '.join(str(arg) for arg in args)
+# Combined measurement layout (little endian, 14 bytes):
+# seq u16, timestamp ms u32 (time.ticks_ms(), so it wraps at 2**30, about
+# 12.4 days), CO u16, CH4 u16, CO2 u16, battery u8,
+# alarm flags u8 (2 bits per gas: CO bits 0-1, CH4 bits 2-3, CO2 bits 4-5,
+# 0 = normal, 1 = warning, 2 = alert)
+_MEAS_FORMAT = "<HIHHHBB"
+_meas_buf = bytearray(struct.calcsize(_MEAS_FORMAT))
+# The per-gas characteristics are always kept up to date for reading and,
+# for clients that predate the combined one, notified as well. Turning this
+# off (legacy_notify setting, see config.py) saves four radio events per
+# sample once every client uses the combined characteristic.
+legacy_notify = True
+
+# Set to True to broadcast the readings in non-connectable advertising
+# instead of accepting connections, so any number of passive scanners can
+# read them. host/decode_beacon.py decodes the frame.
+ENABLE_BROADCAST = const(False)
+# Broadcast frame, the manufacturer data of the advertising payload (little
+# endian, 12 bytes): company ID u16 (0xFFFF, reserved for testing), version
+# u8, counter u8 (low byte of the sample seq), CO u16, CH4 u16, CO2 u16,
+# battery u8, alarm flags u8 (as in the combined measurement)
+_BEACON_FORMAT = "<HBBHHHBB"
+_BEACON_COMPANY = const(0xFFFF)
+_BEACON_VERSION = const(1)
+# Flags + manufacturer data + name, 29 of the 31 bytes
+_beacon_payload = advertising_payload(
+    name=b"Gas Sensor", manufacturer=bytes(struct.calcsize(_BEACON_FORMAT))
+)
 
-    print(data)
+# Notify a sample only when a channel leaves its deadband, the alarm flags
+# change, or after 30 s of silence. Channels: CO, CH4, CO2, battery
+notify_policy = NotifyPolicy(
+    abs_deadband=(2, 50, 50, 1),
+    rel_deadband_pct=(5, 5, 5, 0),
+    heartbeat_ms=30_000,
+)
 
-    if ENABLE_LOGGING:
-        log_file.write(data + '\n')
-        log_file.flush()
+# History download protocol on history_characteristic
+# Client writes:
+#   request: 0x01, tier u8, start s u32, end s u32, credits u8
+#   ack:     0x02, credits u8  (more chunks may be sent)
+#   cancel:  0x03
+#   clock:   0x04
+# Device notifies chunks: tier u8, flags u8 (bit 0 = last chunk),
+# chunk number u16, then whole records of the tier's format (see history.py).
+# After sending `credits` chunks the device waits for an ack.
+# History timestamps are seconds of the device clock (time.time()), which
+# restarts at every boot, so a client sends clock first. The answer, 0x84,
+# device time s u32, timestamp ms u32, gives the device clock and the
+# measurement timestamp of the same instant: the client converts its range
+# to device seconds with it, and can place the measurement timestamps too.
+_HIST_OP_REQUEST = const(0x01)
+_HIST_OP_ACK = const(0x02)
+_HIST_OP_CANCEL = const(0x03)
+_HIST_OP_CLOCK = const(0x04)
+_HIST_REQUEST_FORMAT = "<BBIIB"
+_HIST_CHUNK_HEADER = "<BBH"
+_HIST_CLOCK_FORMAT = "<BII"
+_HIST_ACK_TIMEOUT_MS = const(5000)
+# Raw samples every 10 s for an hour, minute rollups for 6 hours and hourly
+# rollups for a week (~16 kB in total)
+history = History()
+
+log = logger.Logger("log.txt", logger.INFO, to_file=ENABLE_LOGGING)
+
+# Persistent record of the readings on flash: one averaged record per minute
+# in 12 segments of 4096 records (~34 days, 9 bytes per record)
+ENABLE_RECORDING = const(True)
+recorder = Recorder() if ENABLE_RECORDING else None
+
+# Restarts failed tasks and feeds the watchdog while the critical ones
+# (sampler, lcd) keep making progress
+supervisor = Supervisor(log.warning)
+
+# Owns the tasks of each connected central
+# A central that just dropped (or a phone walking out of range) gets a fast
+# advertising burst to reconnect quickly
+connections = ConnectionManager(_MAX_CONNECTIONS, log.info,
+                                on_disconnect=lambda connection: advertiser.burst())
+
+profiler = Profiler(ENABLE_PROFILING)
+# Probes in the order they appear in the diagnostics payload
+_PROBES = ("read_gas_sensor", "gas_ppm", "acquire", "write_to_LCD", "lcd", "notify", "gc")
+for _name in _PROBES:
+    profiler.probe(_name)
+_lcd_probe = profiler.probe("lcd")
+_notify_probe = profiler.probe("notify")
+_gc_probe = profiler.probe("gc")
+
+# Diagnostics layout (little endian), refreshed every second:
+# uptime s u32, heap free u32, lowest heap free u32, LCD I2C transactions
+# u32, LCD I2C bytes u32, LCD operations dropped u16, task restarts u16,
+# worst loop lag ms u16, loop lag histogram 8 x u16 (< 1, < 2, < 4 ... < 64,
+# >= 64 ms, saturating), then per probe (see _PROBES) calls u32, total us u32
+# (wraps at 2**30) and worst us u32. Probe and lag figures stay 0 unless
+# ENABLE_PROFILING.
+# Then the power figures: estimated runtime left s u32, average draw uA u32
+# and time spent in lightsleep s u32.
+_DIAG_HEADER = "<IIIIIHHH"
+_DIAG_PROBE = "<III"
+_DIAG_LAG_OFFSET = struct.calcsize(_DIAG_HEADER)
+_DIAG_PROBES_OFFSET = _DIAG_LAG_OFFSET + 2 * LAG_BUCKETS
+_DIAG_POWER = "<III"
+_DIAG_POWER_OFFSET = _DIAG_PROBES_OFFSET + len(_PROBES) * struct.calcsize(_DIAG_PROBE)
+_diag_buf = bytearray(_DIAG_POWER_OFFSET + struct.calcsize(_DIAG_POWER))
+
+# Text of both LCD lines, formatted in place by lcd_task
+_lcd_text = bytearray(32)
+_lcd_line1 = memoryview(_lcd_text)[0:16]
+_lcd_line2 = memoryview(_lcd_text)[16:32]
+
+# Legacy per-gas values, packed in place and written from memoryviews
+_legacy_buf = bytearray(8)
+_legacy_co = memoryview(_legacy_buf)[0:2]
+_legacy_ch4 = memoryview(_legacy_buf)[2:4]
+_legacy_co2 = memoryview(_legacy_buf)[4:6]
+_legacy_batt = memoryview(_legacy_buf)[6:8]
+_policy_values = array("i", (0, 0, 0, 0))
+
+# Power saving: lightsleep between samples while no central is connected,
+# sampling every 2 s instead of 0.5 s and slower advertising once readings
+# have been stable for 30 s, and a backlight that dims after 1 minute and
+# turns off after 5 minutes without activity (alerts always light it)
+ENABLE_POWER_SAVING = const(True)
+# Battery capacity and estimated draw of each component in uA, for the
+# runtime estimate. Rough datasheet figures, tune them to the real board.
+_BATTERY_MAH = const(2000)
+_MCU_ACTIVE_UA = const(30_000)
+_MCU_SLEEP_UA = const(2_000)
+# Three MQ heaters at ~150 mA each, on whenever the board is
+_HEATERS_UA = const(450_000)
+_LCD_UA = const(2_000)
+# Backlight at full white; dimming scales it
+_BACKLIGHT_UA = const(60_000)
+_RADIO_CONNECTED_UA = const(4_000)
+# Charge of one advertising event (3 channels) in nC
+_ADV_EVENT_NC = const(15_000)
+
+# Collect garbage right after each sample has been handled, while the loop is
+# idle, instead of whenever an allocation happens to run out of heap (which
+# may be in the middle of a BLE event)
+ENABLE_IDLE_GC = const(True)
+# Delay after a sample before collecting, enough for the consumers to finish
+_IDLE_GC_DELAY_MS = const(100)
 
 # Write to LCD and set backlight
-def write_to_LCD(line1: str, line2: str, backlight: str = "normal"):
-    # Truncate strings to 16 characters - LCD is 16x2
-    line1 = line1[:16]
-    line2 = line2[:16]
-
-    # Clear LCD
-    LCD.clear()
-    
-    # Write both lines to LCD
-    LCD.setCursor(0, 0)
-    LCD.printout(line1)
-    LCD.setCursor(0, 1)
-    LCD.printout(line2)
+# Lines are str or bytes-like (see _lcd_text), level is an alarms level,
+# brightness (0 - 255) dims the backlight unless there is an alert
+@profiler.timed("write_to_LCD")
+def write_to_LCD(line1, line2, level=alarms.NORMAL, brightness=255):
+    # Write both lines to LCD, only the cells that changed are sent
+    # Only the first 16 characters are drawn - LCD is 16x2
+    LCD.update(line1, line2)
 
     # Set backlight
-    if (backlight == "normal"):
-        LCD.setRGB(255, 255, 255)
-    elif (backlight == "warning"):
-        LCD.setRGB(255, 255, 0)
-    elif (backlight == "alert"):
+    # Register writes are cached by the driver, so an unchanged colour or
+    # blink pattern costs no I2C traffic
+    if (level == alarms.ALERT):
         LCD.setRGB(255, 0, 0)
+        # Blinking is done by the backlight controller itself
+        LCD.blinkLED(500, 128)
+        return
+
+    if brightness < 255:
+        LCD.setBrightness(brightness)
+    else:
+        LCD.noBlinkLED()
+    if (level == alarms.WARNING):
+        LCD.setRGB(255, 255, 0)
     else:
         LCD.setRGB(255, 255, 255)
 
-def read_gas_sensor(adc : ADC):
-    # Read the analog value (0 - 65535)
-    raw_adc = adc.read_u16()
+@profiler.timed("read_gas_sensor")
+def read_gas_sensor(adc : BurstADC):
+    # Read the filtered analog value (0 - 65535)
+    return adc_to_rs(adc.read_u16())
 
+def adc_to_rs(raw_adc):
     # Calculate voltage seen by ADC
     adc_voltage = raw_adc * 3.3 / 65535.0
     # Reverse voltage divider to find sensor voltage
@@ -135,6 +341,7 @@ def read_gas_sensor(adc : ADC):
 
     return Rs
 
+@profiler.timed("gas_ppm")
 def gas_ppm(Rs, Ro, MQ_m, MQ_b):
     # Rs/Ro ratio
     ratio = Rs / Ro
@@ -149,34 +356,51 @@ def gas_ppm(Rs, Ro, MQ_m, MQ_b):
 
     return round(ppm)
 
-def warning_levels(ppm_CO, ppm_CH4, ppm_CO2):
-    # Initialize Levels
-    level_CO = "normal"
-    level_CH4 = "normal"
-    level_CO2 = "normal"
-
-    # Check levels
-
-    # CO Warning - OSHA PEL (permissible exposure limit)
-    if (ppm_CO >= 50):
-        level_CO = "warning"
-    # CO Alert - NIOSH C (ceiling level)
-    if (ppm_CO >= 200):
-        level_CO = "alert"
-    # CH4 Warning - Committee on Toxicology recommended long-term exposure limit
-    if (ppm_CH4 >= 5000):
-        level_CH4 = "warning"
-    # CH4 Alert - concentration at which methane becomes flammable
-    if (ppm_CH4 >= 50_000):
-        level_CH4 = "alert"
-    # CO2 Warning - OSHA PEL
-    if (ppm_CO2 >= 5000):
-        level_CO2 = "warning"
-    # CO2 Alert - NIOSH ST (short term limit)
-    if (ppm_CO2 >= 30_000):
-        level_CO2 = "alert"
-
-    return level_CO, level_CH4, level_CO2
+# Build (or load from flash) the raw ADC code -> ppm table of one sensor
+def gas_lut(name, Ro, MQ_m, MQ_b):
+    return cached_lut(
+        "lut_" + name + ".bin",
+        lambda raw: gas_ppm(adc_to_rs(raw), Ro, MQ_m, MQ_b),
+        (Ro, MQ_m, MQ_b),
+    )
+
+# Lookup tables replacing the log10/pow math for every reading
+MQ_4_LUT = gas_lut("mq4", MQ_4_RO, MQ_4_M, MQ_4_B)
+MQ_7_LUT = gas_lut("mq7", MQ_7_RO, MQ_7_M, MQ_7_B)
+MQ_135_LUT = gas_lut("mq135", MQ_135_RO, MQ_135_M, MQ_135_B)
+
+# Build a new table for one sensor without stalling the event loop; the old
+# one stays in use until it is swapped in
+async def rebuild_lut(name, Ro, MQ_m, MQ_b):
+    lut = GasLUT()
+    for _ in lut.build_steps(lambda raw: gas_ppm(adc_to_rs(raw), Ro, MQ_m, MQ_b)):
+        await asyncio.sleep_ms(0)
+    try:
+        lut.save("lut_" + name + ".bin", (Ro, MQ_m, MQ_b))
+    except OSError:
+        pass
+    return lut
+
+# Alarm thresholds in ppm per gas, in the order CO, CH4, CO2 (see
+# alarms.py): warn, alert, 8-hour TWA (-> warning), 15-minute STEL
+# (-> alert), hysteresis %. 0 = not used. Limits defined as time-weighted
+# averages go in the TWA/STEL columns only: an instantaneous limit at the
+# same level would always trip first and make the average pointless.
+ALARM_TABLE = (
+    # CO: OSHA PEL 50 ppm (8-hour TWA), NIOSH ceiling 200 ppm (never to be
+    # exceeded, so instantaneous)
+    (0, 200, 50, 0, 10),
+    # CH4: the hazard is flammability, which does not accumulate, so both
+    # limits are instantaneous: warning at 10 % of the lower explosive limit
+    # (5000 ppm, also the Committee on Toxicology long-term limit), alert at
+    # the LEL of 50 000 ppm
+    (5000, 50_000, 0, 0, 10),
+    # CO2: OSHA PEL 5000 ppm (8-hour TWA), NIOSH ST 30 000 ppm (15-minute
+    # STEL), NIOSH IDLH 40 000 ppm (instantaneous)
+    (0, 40_000, 5000, 30_000, 10),
+)
+alarm_engine = AlarmEngine(ALARM_TABLE)
+_alarm_values = array("i", (0, 0, 0))
 
 # Measures battery voltage, returns charge percent
 def measure_batt():
@@ -189,117 +413,582 @@ def measure_batt():
     batt_percent = 83.333 * batt_voltage - 250
     return round(batt_percent)
 
-def mean(values):
-    return sum(values) / len(values) if values else 0
-
-async def batt_rolling_avg():
-    global batt_avg
-    batt_values = []
-
-    while True:
-        batt = measure_batt()
-
-        if len(batt_values) >= 40:
-            batt_values.pop(0)
-
-        batt_values.append(batt)
-
-        batt_avg = round(mean(batt_values))
-        if (batt_avg < 0):
-            batt_avg = 0
-        if (batt_avg > 100):
-            batt_avg = 100
-
-        await asyncio.sleep_ms(50)
+# Held while notifying so that the battery monitor never swaps the pins
+# shared with the wireless chip in the middle of a notification burst
+radio_lock = asyncio.Lock()
+battery = BatteryMonitor(measure_batt, radio_lock)
+
+# Acquire every channel once into the sampler's snapshot
+@profiler.timed("acquire")
+def acquire(snap):
+    co_ppm = MQ_7_LUT.ppm(MQ_7.read_u16())
+    ch4_ppm = MQ_4_LUT.ppm(MQ_4.read_u16())
+    # Offset by outdoor CO2, kept within the range of a <H field
+    co2_ppm = min(MQ_135_LUT.ppm(MQ_135.read_u16()) + 424, 65535)
+    # Alarm levels follow every sample, whoever consumes it
+    values = _alarm_values
+    values[0] = co_ppm
+    values[1] = ch4_ppm
+    values[2] = co2_ppm
+    alarm_engine.update(values, time.ticks_ms())
+    supervisor.progress("sampler")
+    snap.co = co_ppm
+    snap.ch4 = ch4_ppm
+    snap.co2 = co2_ppm
+    snap.batt = battery.percent
+
+# Single source of readings for the LCD and BLE tasks
+sampler = Sampler(acquire, 500)
+
+energy = EnergyModel(_BATTERY_MAH)
+energy.set("heaters", _HEATERS_UA)
+energy.set("lcd", _LCD_UA)
+power = PowerManager(
+    sampler, energy,
+    lightsleep=lightsleep if ENABLE_POWER_SAVING else None,
+    active_ua=_MCU_ACTIVE_UA,
+    sleep_ua=_MCU_SLEEP_UA,
+    max_sleep_ms=MAX_BLOCK_MS,
+    active_period_ms=500,
+    stable_period_ms=2000 if ENABLE_POWER_SAVING else 500,
+    active_adv_us=_ADV_INTERVAL_US,
+    stable_adv_us=_ADV_STABLE_INTERVAL_US if ENABLE_POWER_SAVING else _ADV_INTERVAL_US,
+    dim_after_ms=60_000 if ENABLE_POWER_SAVING else 1 << 29,
+    off_after_ms=300_000 if ENABLE_POWER_SAVING else 1 << 29,
+)
+advertiser = AdvertisingScheduler(
+    aioble.advertise,
+    lambda: power.adv_interval_us,
+    _ADV_NAMES,
+    steps=_ADV_BURST_STEPS,
+    max_slice_ms=_ADV_SLICE_MS,
+)
+# Readings count as stable while they stay within these deadbands (same as
+# the notifications, without a heartbeat). Channels: CO, CH4, CO2, battery
+_stability = NotifyPolicy(
+    abs_deadband=(2, 50, 50, 1),
+    rel_deadband_pct=(5, 5, 5, 0),
+    heartbeat_ms=1 << 29,
+)
+_stability_values = array("i", (0, 0, 0, 0))
 
 async def lcd_task():
+    seq = -1
     while True:
-        co_ppm = gas_ppm(read_gas_sensor(MQ_7), MQ_7_RO, MQ_7_M, MQ_7_B)
-        ch4_ppm = gas_ppm(read_gas_sensor(MQ_4), MQ_4_RO, MQ_4_M, MQ_4_B)
-        co2_ppm = gas_ppm(read_gas_sensor(MQ_135), MQ_135_RO, MQ_135_M, MQ_135_B) + 424
-        batt = batt_avg
-
-        level_CO, level_CH4, level_CO2 = warning_levels(co_ppm, ch4_ppm, co2_ppm)
-        line1 = f"CO:{co_ppm} CH4:{ch4_ppm}"[:16]
-        line2 = f"CO2:{co2_ppm} BAT:{batt}%"[:16]
-        backlight = "normal"
-
-        if any(level == "alert" for level in [level_CO, level_CH4, level_CO2]):
-            backlight = "alert"
-        if any(level == "warning" for level in [level_CO, level_CH4, level_CO2]):
-            backlight = "warning"
-
-        # Testing
-        #line1 = f"CO:{level_CO[:1]},CO2:{level_CO2[:1]},{backlight[:1]}"[:16]
-        #line2 = f"CH4:{level_CH4[:1]},BAT:{batt}%"[:16]
-
-        write_to_LCD(line1, line2, backlight)
-        await asyncio.sleep_ms(500)
-
-async def transmit_data(connection):
+        snap = await sampler.next(seq)
+        if ENABLE_PROFILING:
+            started = time.ticks_us()
+        seq = snap.seq
+        co_ppm = snap.co
+        ch4_ppm = snap.ch4
+        co2_ppm = snap.co2
+        batt = snap.batt
+
+        # "CO:{co} CH4:{ch4}" and "CO2:{co2} BAT:{batt}%", cut to 16
+        # characters, formatted without allocating
+        text = _lcd_text
+        pos = put_bytes(text, 0, 16, b"CO:")
+        pos = put_int(text, pos, 16, co_ppm)
+        pos = put_bytes(text, pos, 16, b" CH4:")
+        pos = put_int(text, pos, 16, ch4_ppm)
+        pad(text, pos, 16)
+        pos = put_bytes(text, 16, 32, b"CO2:")
+        pos = put_int(text, pos, 32, co2_ppm)
+        if ENABLE_POWER_SAVING and time.ticks_ms() // 5000 & 1:
+            # Every other 5 s the estimated runtime left replaces the
+            # battery level: "~12h" or "~45m"
+            pos = put_bytes(text, pos, 32, b" ~")
+            runtime_s = energy.runtime_s
+            if runtime_s >= 3600:
+                pos = put_int(text, pos, 32, runtime_s // 3600)
+                pos = put_bytes(text, pos, 32, b"h")
+            else:
+                pos = put_int(text, pos, 32, runtime_s // 60)
+                pos = put_bytes(text, pos, 32, b"m")
+        else:
+            pos = put_bytes(text, pos, 32, b" BAT:")
+            pos = put_int(text, pos, 32, batt)
+            pos = put_bytes(text, pos, 32, b"%")
+        pad(text, pos, 32)
+
+        # Highest level of any gas, so an alert is never masked by a warning
+        write_to_LCD(_lcd_line1, _lcd_line2, alarm_engine.level, power.brightness)
+        supervisor.progress("lcd")
+        if ENABLE_PROFILING:
+            _lcd_probe.add(time.ticks_diff(time.ticks_us(), started))
+
+# Apply the power decisions for every sample and account for the energy
+async def power_task():
+    seq = -1
     while True:
-        co_ppm = gas_ppm(read_gas_sensor(MQ_7), MQ_7_RO, MQ_7_M, MQ_7_B)
-        co_characteristic.write(struct.pack("<H", co_ppm))
-        co_characteristic.notify(connection)
-        await asyncio.sleep_ms(50)
-        ch4_ppm = gas_ppm(read_gas_sensor(MQ_4), MQ_4_RO, MQ_4_M, MQ_4_B)
-        ch4_characteristic.write(struct.pack("<H", ch4_ppm))
-        ch4_characteristic.notify(connection)
-        await asyncio.sleep_ms(50)
-        co2_ppm = gas_ppm(read_gas_sensor(MQ_135), MQ_135_RO, MQ_135_M, MQ_135_B) + 424
-        co2_characteristic.write(struct.pack("<H", co2_ppm))
-        co2_characteristic.notify(connection)
-        await asyncio.sleep_ms(50)
-        batt = batt_avg
-        batt_characteristic.write(struct.pack("<H", batt))
-        batt_characteristic.notify(connection)
-        await asyncio.sleep_ms(500)
+        snap = await sampler.next(seq)
+        seq = snap.seq
+        values = _stability_values
+        values[0] = snap.co
+        values[1] = snap.ch4
+        values[2] = snap.co2
+        values[3] = snap.batt
+        alarm = alarm_engine.level != alarms.NORMAL
+        advertiser.alarm(alarm_engine.level)
+        power.update(_stability.check(values, alarm_engine.flags(), snap.ticks_ms), alarm)
+
+        brightness = 255 if alarm_engine.level == alarms.ALERT else power.brightness
+        energy.set("backlight", _BACKLIGHT_UA * brightness // 255)
+        radio = len(connections) * _RADIO_CONNECTED_UA
+        if not connections.full():
+            radio += _ADV_EVENT_NC * 1000 // advertiser.interval_us()
+        energy.set("radio", radio)
+
+# Lightsleep only while nothing needs the CPU between samples
+def may_sleep():
+    return (not connections.active
+            and alarm_engine.level == alarms.NORMAL
+            and not LCD.pending()
+            and calibration_task is None)
+
+# Keep the latest snapshot in scratch registers that survive a reset
+async def retain_task():
+    seq = -1
+    while True:
+        snap = await sampler.next(seq)
+        seq = snap.seq
+        retained.save(snap)
 
+# Add every snapshot to the on-device history and the flash recording
+async def history_record_task():
+    seq = -1
+    while True:
+        snap = await sampler.next(seq)
+        seq = snap.seq
+        now = time.time()
+        history.add(now, snap.co, snap.ch4, snap.co2, snap.batt)
+        if recorder:
+            recorder.add(now, snap.co, snap.ch4, snap.co2, snap.batt)
+
+# State of one history download, acks and cancels are routed to it by
+# history_task
+class HistoryTransfer:
+    def __init__(self, credits):
+        self.credits = credits
+        self.cancelled = False
+        self.event = asyncio.Event()
+
+# Download in progress per connection
+history_transfers = {}
+
+# Stream the records of one tier between start and end (seconds) in
+# MTU-sized chunks, waiting for the client to grant more credits
+async def send_history(connection, transfer, tier_id, start, end):
+    tier = history.tier(tier_id)
+    size = tier.record_size
+    header = struct.calcsize(_HIST_CHUNK_HEADER)
+    # ATT notifications carry MTU - 3 bytes
+    per_chunk = max(1, ((connection.mtu or 23) - 3 - header) // size)
+    chunk = bytearray(header + per_chunk * size)
+    n = tier.find(start)
+    chunk_number = 0
 
-async def receive_data(connection):
+    try:
+        while not transfer.cancelled:
+            # Notify a whole credit batch holding radio_lock, so the battery
+            # monitor never swaps the pins the radio shares mid-burst
+            async with radio_lock:
+                while True:
+                    # Skip records overwritten since the last chunk
+                    n = max(n, tier.first())
+                    count = 0
+                    while count < per_chunk and n < tier.total and tier.timestamp(n) <= end:
+                        offset = header + count * size
+                        chunk[offset:offset + size] = tier.record(n)
+                        n += 1
+                        count += 1
+                    last = n >= tier.total or tier.timestamp(n) > end
+
+                    struct.pack_into(_HIST_CHUNK_HEADER, chunk, 0, tier_id, 1 if last else 0, chunk_number)
+                    try:
+                        history_characteristic.notify(connection, memoryview(chunk)[:header + count * size])
+                    except OSError:
+                        # Disconnecting or out of buffers: the client asks
+                        # again for what it is missing
+                        log.warning("History transfer ended by the radio")
+                        return
+                    chunk_number += 1
+                    if last:
+                        return
+
+                    transfer.credits -= 1
+                    if transfer.credits <= 0 or transfer.cancelled:
+                        break
+                    await asyncio.sleep_ms(0)
+
+            while transfer.credits <= 0 and not transfer.cancelled:
+                transfer.event.clear()
+                try:
+                    await asyncio.wait_for(transfer.event.wait(), _HIST_ACK_TIMEOUT_MS / 1000)
+                except asyncio.TimeoutError:
+                    log.warning("History transfer timed out")
+                    return
+            await asyncio.sleep_ms(0)
+    finally:
+        if history_transfers.get(connection) is transfer:
+            del history_transfers[connection]
+
+# Single reader of history_characteristic writes from every central
+async def history_task():
+    while True:
+        connection, data = await history_characteristic.written()
+        if not data:
+            continue
+        transfer = history_transfers.get(connection)
+
+        if data[0] == _HIST_OP_ACK and len(data) >= 2:
+            if transfer:
+                transfer.credits += data[1]
+                transfer.event.set()
+        elif data[0] == _HIST_OP_CANCEL:
+            if transfer:
+                transfer.cancelled = True
+                transfer.event.set()
+        elif data[0] == _HIST_OP_CLOCK:
+            answer = struct.pack(_HIST_CLOCK_FORMAT, _HIST_OP_CLOCK | 0x80,
+                                 time.time(), time.ticks_ms())
+            async with radio_lock:
+                try:
+                    history_characteristic.notify(connection, answer)
+                except OSError:
+                    pass
+        elif data[0] == _HIST_OP_REQUEST and len(data) == struct.calcsize(_HIST_REQUEST_FORMAT):
+            _, tier_id, start, end, credits = struct.unpack(_HIST_REQUEST_FORMAT, data)
+            if tier_id > TIER_HOUR:
+                continue
+            # A new request replaces a running one
+            if transfer:
+                transfer.cancelled = True
+                transfer.event.set()
+            transfer = HistoryTransfer(credits or 255)
+            history_transfers[connection] = transfer
+            # Owned by the connection, so it is cancelled on disconnect
+            connections.spawn(connection, send_history(connection, transfer, tier_id, start, end))
+
+# Notify every connected central from one loop, so readings are shared
+# instead of sampled per connection
+async def transmit_data():
+    seq = -1
+    while True:
+        snap = await sampler.next(seq)
+        seq = snap.seq
+        flags = alarm_engine.flags()
+        struct.pack_into(_MEAS_FORMAT, _meas_buf, 0, snap.seq, snap.ticks_ms,
+                         snap.co, snap.ch4, snap.co2, snap.batt, flags)
+
+        # Values stay readable even when they are not notified
+        measurement_characteristic.write(_meas_buf)
+        struct.pack_into("<HHHH", _legacy_buf, 0, snap.co, snap.ch4, snap.co2, snap.batt)
+        co_characteristic.write(_legacy_co)
+        ch4_characteristic.write(_legacy_ch4)
+        co2_characteristic.write(_legacy_co2)
+        batt_characteristic.write(_legacy_batt)
+
+        if not connections.active:
+            continue
+        values = _policy_values
+        values[0] = snap.co
+        values[1] = snap.ch4
+        values[2] = snap.co2
+        values[3] = snap.batt
+        if not notify_policy.check(values, flags, snap.ticks_ms):
+            continue
+
+        async with radio_lock:
+            if ENABLE_PROFILING:
+                started = time.ticks_us()
+            for connection in connections.active:
+                try:
+                    measurement_characteristic.notify(connection)
+                    if legacy_notify:
+                        co_characteristic.notify(connection)
+                        ch4_characteristic.notify(connection)
+                        co2_characteristic.notify(connection)
+                        batt_characteristic.notify(connection)
+                except OSError:
+                    # Disconnecting, the connection manager will drop it
+                    pass
+            if ENABLE_PROFILING:
+                _notify_probe.add(time.ticks_diff(time.ticks_us(), started))
+
+# Run the garbage collector in the idle window after each sample
+async def idle_gc_task():
+    seq = -1
+    while True:
+        snap = await sampler.next(seq)
+        seq = snap.seq
+        await asyncio.sleep_ms(_IDLE_GC_DELAY_MS)
+        if ENABLE_PROFILING:
+            started = time.ticks_us()
+        gc.collect()
+        if ENABLE_PROFILING:
+            _gc_probe.add(time.ticks_diff(time.ticks_us(), started))
+
+# Refresh the diagnostics characteristic once a second
+async def diagnostics_task():
+    booted = time.time()
+    buf = _diag_buf
+    while True:
+        profiler.sample_heap()
+        transactions, nbytes = LCD.i2c_counters()
+        struct.pack_into(_DIAG_HEADER, buf, 0,
+                         time.time() - booted,
+                         profiler.mem_free, profiler.mem_free_min,
+                         transactions & 0xFFFFFFFF, nbytes & 0xFFFFFFFF,
+                         min(LCD.dropped, 0xFFFF), min(supervisor.total_restarts(), 0xFFFF),
+                         min(profiler.lag_max_ms, 0xFFFF))
+        for i in range(LAG_BUCKETS):
+            struct.pack_into("<H", buf, _DIAG_LAG_OFFSET + 2 * i, min(profiler.lag[i], 0xFFFF))
+        offset = _DIAG_PROBES_OFFSET
+        for p in profiler.probes:
+            struct.pack_into(_DIAG_PROBE, buf, offset, p.count & 0xFFFFFFFF, p.total_us, p.max_us)
+            offset += 12
+        struct.pack_into(_DIAG_POWER, buf, _DIAG_POWER_OFFSET, energy.runtime_s,
+                         energy.average_ua, power.slept_ms // 1000)
+        diagnostics_characteristic.write(buf)
+        await asyncio.sleep_ms(1000)
+
+# Calibration in progress, if any
+calibration_task = None
+
+# Answer a command; the result also stays readable on the characteristic
+async def reply(connection, message):
+    recv_characteristic.write(message)
+    async with radio_lock:
+        try:
+            recv_characteristic.notify(connection)
+        except OSError:
+            # Disconnected meanwhile, the result stays readable
+            pass
+
+# Recalibrate the clean-air Ro of every sensor. The device must be in clean
+# air; sampling stops once every mean is known to within 1 %.
+async def calibrate(connection):
+    global calibration_task, MQ_4_RO, MQ_7_RO, MQ_135_RO, MQ_4_LUT, MQ_7_LUT, MQ_135_LUT
+    try:
+        # Unfiltered bursts on the same pins. The EMA the sampler reads
+        # through makes successive values correlated, which would narrow the
+        # confidence interval and stop the calibration too early.
+        mq_4 = BurstADC(_MQ_4_ADC, 8, REDUCE_TRIMMED, trim=2)
+        mq_7 = BurstADC(_MQ_7_ADC, 8, REDUCE_TRIMMED, trim=2)
+        mq_135 = BurstADC(_MQ_135_ADC, 8, REDUCE_TRIMMED, trim=2)
+        cal = calibration.Calibration((
+            lambda: read_gas_sensor(mq_4),
+            lambda: read_gas_sensor(mq_7),
+            lambda: read_gas_sensor(mq_135),
+        ))
+        result = await cal.run()
+        if result is None:
+            log.warning("Calibration did not converge after", cal.elapsed_ms, "ms")
+            await reply(connection, b"CAL FAIL")
+            return
+        MQ_4_RO, MQ_7_RO, MQ_135_RO = result
+        log.info("Calibrated in", cal.elapsed_ms, "ms, Ro:", MQ_4_RO, MQ_7_RO, MQ_135_RO)
+        try:
+            calibration.save(_CALIB_FILE, {"mq4": MQ_4_RO, "mq7": MQ_7_RO, "mq135": MQ_135_RO})
+        except OSError as e:
+            log.warning("Could not save calibration:", repr(e))
+        MQ_4_LUT = await rebuild_lut("mq4", MQ_4_RO, MQ_4_M, MQ_4_B)
+        MQ_7_LUT = await rebuild_lut("mq7", MQ_7_RO, MQ_7_M, MQ_7_B)
+        MQ_135_LUT = await rebuild_lut("mq135", MQ_135_RO, MQ_135_M, MQ_135_B)
+        await reply(connection, b"CAL OK")
+    finally:
+        calibration_task = None
+
+# Settings that can be changed over BLE (config.py), saved to config.json.
+# Keys of the binary protocol:
+_KEY_PERIOD = const(0x01)
+_KEY_STABLE_PERIOD = const(0x02)
+_KEY_STABLE_AFTER = const(0x03)
+_KEY_HEARTBEAT = const(0x04)
+_KEY_CO_DEADBAND = const(0x05)
+_KEY_CH4_DEADBAND = const(0x06)
+_KEY_CO2_DEADBAND = const(0x07)
+_KEY_ADV_INTERVAL = const(0x08)
+_KEY_EMA_SHIFT = const(0x09)
+_KEY_STABLE_ADV_INTERVAL = const(0x0A)
+_KEY_LEGACY_NOTIFY = const(0x0B)
+# The sampler and lcd tasks report progress once per sample and must do so
+# within their supervisor deadline (5 s) for the watchdog to be fed, so the
+# sample period stays well below it
+_MAX_PERIOD_MS = const(4000)
+settings = config.Settings("config.json")
+settings.add(_KEY_PERIOD, "period_ms", 100, _MAX_PERIOD_MS, power.active_period_ms,
+             lambda v: setattr(power, "active_period_ms", v))
+settings.add(_KEY_STABLE_PERIOD, "stable_period_ms", 100, _MAX_PERIOD_MS, power.stable_period_ms,
+             lambda v: setattr(power, "stable_period_ms", v))
+settings.add(_KEY_STABLE_AFTER, "stable_after_ms", 1000, 3_600_000, power.stable_after_ms,
+             lambda v: setattr(power, "stable_after_ms", v))
+settings.add(_KEY_HEARTBEAT, "heartbeat_ms", 1000, 3_600_000, notify_policy.heartbeat_ms,
+             lambda v: setattr(notify_policy, "heartbeat_ms", v))
+
+# A deadband applies to the notifications and to the power manager's idea of
+# stable readings alike
+def _set_deadband(channel, value):
+    notify_policy.set_deadband(channel, value, notify_policy.rel_deadband_pct[channel])
+    _stability.set_deadband(channel, value, _stability.rel_deadband_pct[channel])
+
+settings.add(_KEY_CO_DEADBAND, "co_deadband", 0, 1000, notify_policy.abs_deadband[0],
+             lambda v: _set_deadband(0, v))
+settings.add(_KEY_CH4_DEADBAND, "ch4_deadband", 0, 10_000, notify_policy.abs_deadband[1],
+             lambda v: _set_deadband(1, v))
+settings.add(_KEY_CO2_DEADBAND, "co2_deadband", 0, 10_000, notify_policy.abs_deadband[2],
+             lambda v: _set_deadband(2, v))
+settings.add(_KEY_ADV_INTERVAL, "adv_interval_us", 20_000, 10_240_000, power.active_adv_us,
+             lambda v: setattr(power, "active_adv_us", v))
+settings.add(_KEY_STABLE_ADV_INTERVAL, "stable_adv_interval_us", 20_000, 10_240_000,
+             power.stable_adv_us, lambda v: setattr(power, "stable_adv_us", v))
+
+# The averages restart so the old shift's state does not carry over
+def _set_ema_shift(shift):
+    for adc in (MQ_4, MQ_7, MQ_135):
+        adc.ema_shift = shift
+        adc.reset()
+
+settings.add(_KEY_EMA_SHIFT, "ema_shift", 0, 6, MQ_4.ema_shift, _set_ema_shift)
+
+def _set_legacy_notify(value):
+    global legacy_notify
+    legacy_notify = bool(value)
+
+settings.add(_KEY_LEGACY_NOTIFY, "legacy_notify", 0, 1, 1, _set_legacy_notify)
+settings.load()
+
+# Profiles, selected with the PROFILE opcode by number
+PROFILE_IDLE = const(0)
+PROFILE_INVESTIGATION = const(1)
+commands = config.CommandProtocol(settings, (
+    # Idle: slow sampling and advertising, wide deadbands, rare heartbeats
+    (
+        (_KEY_PERIOD, 2000),
+        (_KEY_STABLE_PERIOD, _MAX_PERIOD_MS),
+        (_KEY_HEARTBEAT, 120_000),
+        (_KEY_CO_DEADBAND, 5),
+        (_KEY_CH4_DEADBAND, 200),
+        (_KEY_CO2_DEADBAND, 200),
+        (_KEY_ADV_INTERVAL, 1_000_000),
+        (_KEY_STABLE_ADV_INTERVAL, 2_000_000),
+        (_KEY_EMA_SHIFT, 2),
+    ),
+    # Investigation: fast sampling, every small change notified, no smoothing
+    (
+        (_KEY_PERIOD, 250),
+        (_KEY_STABLE_PERIOD, 250),
+        (_KEY_HEARTBEAT, 5000),
+        (_KEY_CO_DEADBAND, 1),
+        (_KEY_CH4_DEADBAND, 10),
+        (_KEY_CO2_DEADBAND, 10),
+        (_KEY_ADV_INTERVAL, 100_000),
+        (_KEY_STABLE_ADV_INTERVAL, 100_000),
+        (_KEY_EMA_SHIFT, 0),
+    ),
+))
+
+# Single reader of recv_characteristic writes from every central
+# Commands (text):
+#   CAL  calibrate the sensors in clean air, answered with "CAL OK" or
+#        "CAL FAIL" when done
+# Binary requests (first byte below 0x20) go to the command protocol in
+# config.py and are answered with its response.
+async def receive_data():
+    global calibration_task
     while True:
         connection, data = await recv_characteristic.written()
+        power.activity()
+        if config.is_binary(data):
+            if log.enabled(logger.INFO):
+                log.info("Command:", data[0])
+            await reply(connection, commands.handle(data))
+            continue
+
         await asyncio.sleep_ms(50)
-        recv_characteristic.notify(connection, b"Received!")
+        async with radio_lock:
+            recv_characteristic.notify(connection, b"Received!")
         await asyncio.sleep_ms(50)
-        _logger("Data received:")
-        _logger(data.decode())
+        if log.enabled(logger.INFO):
+            log.info("Data received:", data.decode())
 
-# Serially wait for connections. Don't advertise while a central is
-# connected.
+        if bytes(data).strip() == b"CAL" and calibration_task is None:
+            calibration_task = asyncio.create_task(calibrate(connection))
+
+# Wait for connections and hand them to the connection manager. Keep
+# advertising while fewer than _MAX_CONNECTIONS centrals are connected.
 async def peripheral_task():
     while True:
-        async with await aioble.advertise(
-            interval_us=_ADV_INTERVAL_US,
-            name="Gas Sensor",
+        await connections.wait_slot()
+        # Returns None whenever the interval or the name should change
+        connection = await advertiser.advertise(
             services=[_ENV_SENSE_UUID],
             appearance=_ADV_APPEARANCE_GENERIC_SENSOR,
-        ) as connection:
-            _logger("Connection from:", connection.device)
-
-            # Start data transmission and reception tasks
-            asyncio.create_task(transmit_data(connection))
-            asyncio.create_task(receive_data(connection))
-
-            await connection.disconnected(timeout_ms=None)
-            _logger("Device disconeccted:", connection.device)
-            await asyncio.sleep_ms(100)
+        )
+        if connection is None:
+            continue
+        log.info("Connection from:", connection.device)
+        connections.open(connection)
+        power.activity()
+        # A new client gets the current sample straight away
+        notify_policy.reset()
+        await asyncio.sleep_ms(100)
+
+# Broadcast every sample by rewriting the frame in the advertising payload
+async def broadcast_task():
+    ble = bluetooth.BLE()
+    seq = -1
+    while True:
+        snap = await sampler.next(seq)
+        seq = snap.seq
+        struct.pack_into(_BEACON_FORMAT, _beacon_payload, MANUFACTURER_OFFSET,
+                         _BEACON_COMPANY, _BEACON_VERSION, snap.seq & 0xFF, snap.co,
+                         snap.ch4, snap.co2, snap.batt, alarm_engine.flags())
+        ble.gap_advertise(advertiser.interval_us(), adv_data=_beacon_payload, connectable=False)
 
 # Run tasks.
 async def main():
+    # Show the readings from before a reset until the first new sample
+    last = retained.load()
+    if last:
+        sampler.restore(*last)
+        battery.restore(last[4])
+
+    supervisor.add("log", log.run)
+    supervisor.add("display", LCD.run)
+    supervisor.add("battery", battery.run)
+    supervisor.add("sampler", sampler.run, critical=True)
+    supervisor.add("retain", retain_task)
+    supervisor.add("history", history_record_task)
+    supervisor.add("history_download", history_task)
+    if ENABLE_BROADCAST:
+        supervisor.add("ble", broadcast_task)
+    else:
+        supervisor.add("ble", peripheral_task)
+    supervisor.add("transmit", transmit_data)
+    supervisor.add("receive", receive_data)
+    supervisor.add("lcd", lcd_task, critical=True)
+    supervisor.add("diagnostics", diagnostics_task)
+    supervisor.add("power", power_task)
+    supervisor.add("energy", lambda: energy.run(lambda: battery.percent))
+    if ENABLE_POWER_SAVING:
+        supervisor.add("sleep", lambda: power.run(may_sleep))
+    if ENABLE_IDLE_GC:
+        supervisor.add("gc", idle_gc_task)
+    if ENABLE_PROFILING:
+        supervisor.add("profiler", profiler.run)
+
     try:
-        tasks = [
-            asyncio.create_task(batt_rolling_avg()),
-            asyncio.create_task(peripheral_task()),
-            asyncio.create_task(lcd_task())
-        ]
-        await asyncio.gather(*tasks)
+        await supervisor.run()
 
     except Exception as e:
-        _logger('An error occurred: ' + str(e))
-        _logger('Ending session and restarting...\n\n')
-        if ENABLE_LOGGING:
-            log_file.close()
+        # Get the buffered log onto flash before restarting
+        log.crash('An error occurred:', repr(e))
+        log.crash('Ending session and restarting...')
+        if recorder:
+            recorder.flush()
         reset()
 
-asyncio.run(main())
+if __name__ == "__main__":
+    asyncio.run(main())
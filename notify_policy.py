@@ -0,0 +1,62 @@
+# Change-driven notification policy.
+#
+# A sample is notified only when it is worth the airtime:
+#   - any channel moved further than its deadband from the value last sent
+#     (the larger of an absolute step and a percentage of that value)
+#   - the alarm flags changed, which is always sent immediately
+#   - nothing was sent for heartbeat_ms, so the client can tell the device is
+#     still alive
+# Deadbands and the heartbeat can be changed at runtime.
+
+import time
+from array import array
+
+
+class NotifyPolicy:
+    # abs_deadband / rel_deadband_pct: one entry per channel
+    def __init__(self, abs_deadband, rel_deadband_pct, heartbeat_ms=30_000):
+        n = len(abs_deadband)
+        self.abs_deadband = array("i", abs_deadband)
+        self.rel_deadband_pct = array("i", rel_deadband_pct)
+        self.heartbeat_ms = heartbeat_ms
+        self._last = array("i", [0] * n)
+        self._last_flags = 0
+        self._last_ms = 0
+        self._sent_any = False
+        # Samples offered and samples sent, for judging the settings
+        self.offered = 0
+        self.sent = 0
+
+    def set_deadband(self, channel, abs_deadband, rel_deadband_pct):
+        self.abs_deadband[channel] = abs_deadband
+        self.rel_deadband_pct[channel] = rel_deadband_pct
+
+    # Forget what was sent, so the next sample goes out (new client)
+    def reset(self):
+        self._sent_any = False
+
+    # Decide whether to notify this sample; if so it becomes the reference
+    # for the deadbands
+    def check(self, values, flags, now_ms):
+        self.offered += 1
+        send = (not self._sent_any
+                or flags != self._last_flags
+                or time.ticks_diff(now_ms, self._last_ms) >= self.heartbeat_ms)
+
+        last = self._last
+        if not send:
+            for i in range(len(last)):
+                delta = abs(values[i] - last[i])
+                if delta > self.abs_deadband[i] and delta * 100 > self.rel_deadband_pct[i] * abs(last[i]):
+                    send = True
+                    break
+
+        if send:
+            for i in range(len(last)):
+                last[i] = values[i]
+            self._last_flags = flags
+            self._last_ms = now_ms
+            self._sent_any = True
+            self.sent += 1
+        return send
+
@@ -0,0 +1,182 @@
+# Power management.
+#
+# PowerManager decides, once per sample:
+#   - the sample period: fast while readings move or an alarm is raised,
+#     slow once they have been stable (within the deadbands) for a while
+#   - the advertising interval, following the same stable/active split
+#   - the backlight level: full while anything happens, dimmed and then off
+#     after a period without activity (an alert always gets full red, see
+#     main.write_to_LCD)
+#   - whether the CPU may lightsleep until the next sample, which is only
+#     allowed when nothing else needs it (no central connected, no alarm,
+#     display idle)
+#
+# EnergyModel integrates the estimated current of every component over time
+# and, once a second (run()), turns the average into an estimated runtime
+# left on the battery. All of it is small-int arithmetic: on the RP2040
+# floats and ints beyond 30 bits live on the heap.
+
+from micropython import const
+import time
+import uasyncio as asyncio
+
+# Wake up this long before the next sample is due
+_WAKE_MARGIN_MS = const(10)
+# Shorter sleeps are not worth the clock switching
+_MIN_SLEEP_MS = const(50)
+# The average current is an EMA over the 1 s means with weight 1 / 2**9,
+# a time constant of about 8.5 minutes, kept in 24.8 fixed point
+_AVG_SHIFT = const(9)
+# Charge is counted in units of 10 uA x 1 ms; one mAh is this many
+_UNITS_PER_MAH = const(360_000_000)
+# Longest span integrated at once, which keeps the product a small int
+_MAX_DT_MS = const(10_000)
+
+
+class EnergyModel:
+    # capacity_mah: battery capacity; currents are set per component in uA
+    def __init__(self, capacity_mah):
+        self.capacity_mah = capacity_mah
+        self._draw = {}
+        self.total_ua = 0
+        # Estimated average current, charge used since boot and runtime left,
+        # updated once a second by run()
+        self.average_ua = 0
+        self.used_mah = 0
+        self.runtime_s = 0
+        self._avg = -1
+        self._used = 0
+        # Charge since the last second, and when that second started
+        self._charge = 0
+        self._window_ms = time.ticks_ms()
+        self._last_ms = self._window_ms
+
+    # Account for the time spent at the old draw, then change one component
+    def set(self, name, ua):
+        old = self._draw.get(name, 0)
+        if old == ua and name in self._draw:
+            return
+        self._integrate()
+        self._draw[name] = ua
+        self.total_ua += ua - old
+
+    def _integrate(self):
+        now = time.ticks_ms()
+        dt = time.ticks_diff(now, self._last_ms)
+        self._last_ms = now
+        if dt > 0:
+            self._charge += self.total_ua // 10 * min(dt, _MAX_DT_MS)
+
+    # Close the current window: update the average, the charge used and the
+    # runtime left with the battery at percent
+    def tick(self, percent):
+        self._integrate()
+        window = time.ticks_diff(self._last_ms, self._window_ms)
+        self._window_ms = self._last_ms
+        charge = self._charge
+        self._charge = 0
+        if window <= 0:
+            return
+        mean = charge // window * 10
+        if self._avg < 0:
+            self._avg = mean << 8
+        else:
+            self._avg += ((mean << 8) - self._avg) >> _AVG_SHIFT
+        self.average_ua = (self._avg + 128) >> 8
+
+        self._used += charge
+        while self._used >= _UNITS_PER_MAH:
+            self._used -= _UNITS_PER_MAH
+            self.used_mah += 1
+
+        # mAh left x 3600 s / mA, with the current in 0.1 mA steps
+        left_mah = self.capacity_mah * max(0, percent) // 100
+        self.runtime_s = left_mah * 36_000 // max(1, self.average_ua // 100)
+
+    # percent(): battery charge left
+    async def run(self, percent, period_ms=1000):
+        while True:
+            await asyncio.sleep_ms(period_ms)
+            self.tick(percent())
+
+
+class PowerManager:
+    # active_ua / sleep_ua: MCU draw awake and in lightsleep
+    # max_sleep_ms: longest lightsleep, below the watchdog timeout
+    def __init__(self, sampler, energy, lightsleep=None, active_ua=0, sleep_ua=0,
+                 max_sleep_ms=5000, active_period_ms=500,
+                 stable_period_ms=2000, active_adv_us=250_000,
+                 stable_adv_us=1_000_000, stable_after_ms=30_000,
+                 dim_after_ms=60_000, off_after_ms=300_000, dim_level=40):
+        self.sampler = sampler
+        self.energy = energy
+        # lightsleep(ms), e.g. machine.lightsleep; None to never sleep
+        self._lightsleep = lightsleep
+        self.active_ua = active_ua
+        self.sleep_ua = sleep_ua
+        self.max_sleep_ms = max_sleep_ms
+        energy.set("mcu", active_ua)
+        self.active_period_ms = active_period_ms
+        self.stable_period_ms = stable_period_ms
+        self.active_adv_us = active_adv_us
+        self.stable_adv_us = stable_adv_us
+        self.stable_after_ms = stable_after_ms
+        self.dim_after_ms = dim_after_ms
+        self.off_after_ms = off_after_ms
+        self.dim_level = dim_level
+        # Current decisions
+        self.stable = False
+        self.brightness = 255
+        self.adv_interval_us = active_adv_us
+        # Time spent in lightsleep, for the diagnostics
+        self.slept_ms = 0
+        self._changed_ms = time.ticks_ms()
+        self._activity_ms = self._changed_ms
+
+    # Something happened that a person may be looking at the display for
+    # (connection, command, alarm)
+    def activity(self):
+        self._activity_ms = time.ticks_ms()
+
+    # Called once per sample: changed is whether any reading left its
+    # deadband, alarm whether an alarm is raised
+    def update(self, changed, alarm):
+        now = time.ticks_ms()
+        if changed or alarm:
+            self._changed_ms = now
+        if alarm:
+            self._activity_ms = now
+
+        self.stable = time.ticks_diff(now, self._changed_ms) >= self.stable_after_ms
+        self.sampler.period_ms = self.stable_period_ms if self.stable else self.active_period_ms
+        self.adv_interval_us = self.stable_adv_us if self.stable else self.active_adv_us
+
+        idle = time.ticks_diff(now, self._activity_ms)
+        if alarm or idle < self.dim_after_ms:
+            self.brightness = 255
+        elif idle < self.off_after_ms:
+            self.brightness = self.dim_level
+        else:
+            self.brightness = 0
+
+    # After every sample, once the consumers are done (settle_ms), sleep
+    # until the next one if may_sleep() allows it
+    async def run(self, may_sleep, settle_ms=150):
+        if self._lightsleep is None:
+            return
+        seq = -1
+        while True:
+            snap = await self.sampler.next(seq)
+            seq = snap.seq
+            await asyncio.sleep_ms(settle_ms)
+            if not may_sleep():
+                continue
+            remaining = time.ticks_diff(self.sampler.deadline, time.ticks_ms()) - _WAKE_MARGIN_MS
+            # The loop is blocked while asleep, so the watchdog is not fed
+            remaining = min(remaining, self.max_sleep_ms)
+            if remaining < _MIN_SLEEP_MS:
+                continue
+            self.energy.set("mcu", self.sleep_ua)
+            self._lightsleep(remaining)
+            self.energy.set("mcu", self.active_ua)
+            self.slept_ms += remaining
@@ -0,0 +1,116 @@
+# Lightweight runtime instrumentation.
+#
+#   - probes: call count, total and worst time (time.ticks_us) of hot
+#     functions, through the @timed(name) decorator or `with probe(name):`
+#   - event loop lag: how late a periodic sleep_ms wakes up, as a histogram
+#     with power-of-two millisecond buckets
+#   - heap: gc.mem_free() now and the lowest value seen
+#
+# A disabled Profiler hands back the undecorated function and run() returns
+# at once, so instrumented code costs nothing in the field unless turned on.
+
+from micropython import const
+import gc
+import time
+import uasyncio as asyncio
+
+# Lag buckets: < 1, < 2, < 4, ... < 64 ms, and 64 ms or more
+LAG_BUCKETS = const(8)
+
+
+class Probe:
+    def __init__(self):
+        self.count = 0
+        self.total_us = 0
+        self.max_us = 0
+        self._start = 0
+
+    def add(self, us):
+        self.count += 1
+        # Wraps at 30 bits (about 18 minutes of busy time) so it stays a
+        # small int; readers take differences modulo 2**30
+        self.total_us = (self.total_us + us) & 0x3FFFFFFF
+        if us > self.max_us:
+            self.max_us = us
+
+    def __enter__(self):
+        self._start = time.ticks_us()
+        return self
+
+    def __exit__(self, *args):
+        self.add(time.ticks_diff(time.ticks_us(), self._start))
+
+    def reset(self):
+        self.count = 0
+        self.total_us = 0
+        self.max_us = 0
+
+
+class Profiler:
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        # Probes in creation order
+        self.probes = []
+        self._names = {}
+        self.lag = [0] * LAG_BUCKETS
+        self.lag_max_ms = 0
+        self.mem_free = 0
+        self.mem_free_min = 0
+
+    def probe(self, name):
+        p = self._names.get(name)
+        if p is None:
+            p = Probe()
+            self._names[name] = p
+            self.probes.append(p)
+        return p
+
+    # Decorator timing every call of a function
+    def timed(self, name):
+        if not self.enabled:
+            return lambda f: f
+        p = self.probe(name)
+
+        def decorate(f):
+            def wrapper(*args, **kwargs):
+                start = time.ticks_us()
+                try:
+                    return f(*args, **kwargs)
+                finally:
+                    p.add(time.ticks_diff(time.ticks_us(), start))
+            return wrapper
+        return decorate
+
+    # Sample the heap, called by whoever publishes the figures
+    def sample_heap(self):
+        self.mem_free = gc.mem_free()
+        if not self.mem_free_min or self.mem_free < self.mem_free_min:
+            self.mem_free_min = self.mem_free
+
+    def reset(self):
+        for p in self.probes:
+            p.reset()
+        for i in range(LAG_BUCKETS):
+            self.lag[i] = 0
+        self.lag_max_ms = 0
+        self.mem_free_min = 0
+
+    # Measure event loop lag: sleep period_ms and record how late the wakeup
+    # is
+    async def run(self, period_ms=100):
+        if not self.enabled:
+            return
+        lag = self.lag
+        while True:
+            start = time.ticks_ms()
+            await asyncio.sleep_ms(period_ms)
+            late = time.ticks_diff(time.ticks_ms(), start) - period_ms
+            if late < 0:
+                late = 0
+            if late > self.lag_max_ms:
+                self.lag_max_ms = late
+            bucket = 0
+            while late and bucket < LAG_BUCKETS - 1:
+                late >>= 1
+                bucket += 1
+            lag[bucket] += 1
@@ -0,0 +1,219 @@
+# Compact binary time-series recorder on flash.
+#
+# Readings are averaged over period_s and appended as fixed-size records to
+# a ring of segment files (rec_0.bin ... rec_<n-1>.bin). Filling a segment
+# moves on to the next one, replacing the oldest, so writes are spread over
+# all of them and the space used never grows.
+#
+# Files are only ever appended to. littlefs (the rp2 default) copies a file
+# from the first changed block to its end when the middle of it is
+# rewritten, so in-place updates would wear the flash far more than the
+# records themselves.
+#
+# Segment layout (little endian):
+#   rec_<n>.bin  header: magic b"GREC", version u8, record size u8,
+#                segment sequence number u32, session u16
+#                then records, each:
+#                dt u16 (s since the previous record, 0 for the first of a
+#                block), CO u16, CH4 u16, CO2 u16, battery u8
+#   rec_<n>.idx  one entry per block: first record number u16, timestamp (s)
+#                of that record u32, session u16
+# A block starts every block_records records, after a gap too long for dt,
+# and at every new session. The session number goes up at every boot and
+# whenever the clock goes back, because time.time() restarts on a reset:
+# within a session timestamps only increase, so the index finds a time range
+# there without scanning, while readings of different sessions stay apart.
+# host/decode_recording.py reads these files on a PC.
+
+from micropython import const
+import os
+import struct
+
+_MAGIC = b"GREC"
+_VERSION = const(2)
+_HEADER = "<4sBBIH"
+_RECORD = "<HHHHB"
+_INDEX = "<HIH"
+_INDEX_SIZE = const(8)
+_DT_MAX = const(0xFFFF)
+
+
+class Recorder:
+    def __init__(self, prefix="rec_", segments=12, segment_records=4096,
+                 block_records=256, period_s=60, buffer_records=16):
+        self.prefix = prefix
+        self.segments = segments
+        self.segment_records = segment_records
+        self.block_records = block_records
+        self.period_s = period_s
+        self.record_size = struct.calcsize(_RECORD)
+        self._header_size = struct.calcsize(_HEADER)
+        # Records waiting to be written
+        self._buf = bytearray(self.record_size * buffer_records)
+        self._buffered = 0
+        self._index = bytearray(_INDEX_SIZE)
+        # Averaging of the samples within one period
+        self._period_start = -1
+        self._sum = [0, 0, 0, 0]
+        self._count = 0
+        self._file = None
+        self._resume()
+
+    def _path(self, slot, ext=".bin"):
+        return self.prefix + str(slot) + ext
+
+    # (sequence number, session) of a slot's segment, None if unusable
+    def _read_header(self, slot):
+        try:
+            with open(self._path(slot), "rb") as f:
+                header = f.read(self._header_size)
+        except OSError:
+            return None
+        if len(header) != self._header_size:
+            return None
+        magic, version, size, seq, session = struct.unpack(_HEADER, header)
+        if magic != _MAGIC or version != _VERSION or size != self.record_size:
+            return None
+        return seq, session
+
+    # Continue after the last record of the newest segment, in a new session
+    def _resume(self):
+        slot = 0
+        seq = 0
+        session = 0
+        for i in range(self.segments):
+            header = self._read_header(i)
+            if header is not None and header[0] > seq:
+                slot = i
+                seq, session = header
+        if not seq:
+            self._new_segment(0, 1, 0)
+            return
+
+        self._slot = slot
+        self._seq = seq
+        size = os.stat(self._path(slot))[6] - self._header_size
+        self._pos = size // self.record_size
+        # The first record starts a block of the new session, so only the
+        # session of the last block is needed
+        self._block_start = self._pos
+        self._last_ts = -1
+        last = self._last_index()
+        if last is not None:
+            session = last[2]
+        self.session = (session + 1) & 0xFFFF
+
+        if size % self.record_size or self._pos >= self.segment_records:
+            # Cut short by a reset mid-record, or full: appending would
+            # misplace every later record
+            self._new_segment((slot + 1) % self.segments, seq + 1, self.session)
+            return
+        self._file = open(self._path(slot), "ab")
+
+    # Last index entry of the current segment as (first record, ts, session)
+    def _last_index(self):
+        path = self._path(self._slot, ".idx")
+        try:
+            entries = os.stat(path)[6] // _INDEX_SIZE
+            if not entries:
+                return None
+            with open(path, "rb") as f:
+                f.seek((entries - 1) * _INDEX_SIZE)
+                return struct.unpack(_INDEX, f.read(_INDEX_SIZE))
+        except OSError:
+            return None
+
+    # Replace the segment of a slot with an empty one. Only the header is
+    # written, so moving on costs no more than an append.
+    def _new_segment(self, slot, seq, session):
+        if self._file:
+            self._file.close()
+        try:
+            os.remove(self._path(slot, ".idx"))
+        except OSError:
+            pass
+        self._file = open(self._path(slot), "wb")
+        self._file.write(struct.pack(_HEADER, _MAGIC, _VERSION, self.record_size, seq, session))
+        self._file.flush()
+        self._slot = slot
+        self._seq = seq
+        self.session = session & 0xFFFF
+        self._pos = 0
+        self._block_start = 0
+        self._last_ts = -1
+
+    # Add one sample taken at ts (seconds); a record is written per period_s
+    def add(self, ts, co, ch4, co2, batt):
+        if self._period_start >= 0 and ts - self._period_start >= self.period_s:
+            n = self._count
+            s = self._sum
+            self._append(self._period_start, (s[0] + n // 2) // n, (s[1] + n // 2) // n,
+                         (s[2] + n // 2) // n, (s[3] + n // 2) // n)
+            for i in range(4):
+                s[i] = 0
+            self._count = 0
+            self._period_start = -1
+
+        if self._period_start < 0:
+            self._period_start = ts
+        s = self._sum
+        s[0] += co
+        s[1] += ch4
+        s[2] += co2
+        s[3] += batt
+        self._count += 1
+
+    def _append(self, ts, co, ch4, co2, batt):
+        if self._pos >= self.segment_records:
+            self.flush()
+            self._new_segment((self._slot + 1) % self.segments, self._seq + 1, self.session)
+
+        dt = ts - self._last_ts
+        if self._last_ts >= 0 and dt < 0:
+            # The clock went back: what follows is another series
+            self.session = (self.session + 1) & 0xFFFF
+            self._last_ts = -1
+        if (self._last_ts < 0 or dt > _DT_MAX
+                or self._pos - self._block_start >= self.block_records):
+            # New block, which carries an absolute timestamp. The records
+            # before it are written first, so its index entry is the record
+            # number at the end of the file.
+            self.flush()
+            struct.pack_into(_INDEX, self._index, 0, self._pos, ts, self.session)
+            with open(self._path(self._slot, ".idx"), "ab") as f:
+                f.write(self._index)
+            self._block_start = self._pos
+            dt = 0
+
+        struct.pack_into(_RECORD, self._buf, self._buffered * self.record_size,
+                         dt, co, ch4, co2, batt)
+        self._buffered += 1
+        self._pos += 1
+        self._last_ts = ts
+        if self._buffered * self.record_size >= len(self._buf):
+            self.flush()
+
+    # Write buffered records to flash
+    def flush(self):
+        if not self._buffered:
+            return
+        self._file.write(memoryview(self._buf)[:self._buffered * self.record_size])
+        self._file.flush()
+        self._buffered = 0
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+    # Remove every segment file
+    def erase(self):
+        self._file.close()
+        self._file = None
+        for slot in range(self.segments):
+            for ext in (".bin", ".idx"):
+                try:
+                    os.remove(self._path(slot, ext))
+                except OSError:
+                    pass
+        self._buffered = 0
+        self._new_segment(0, 1, self.session + 1)
@@ -0,0 +1,50 @@
+# Latest readings kept in RAM that survives a reset.
+#
+# The RP2040 watchdog scratch registers keep their contents across a watchdog
+# or soft reset (machine.reset). Registers 4-7 are used by the bootrom, so
+# 0-3 hold the last snapshot and battery estimate, guarded by a magic number
+# and a checksum so power-on garbage is ignored. save() runs every sample, so
+# every word stays below 2**30 and is a small int on MicroPython:
+#   0: CO u16, battery u8 << 16
+#   1: CH4 u16
+#   2: CO2 u16, magic << 16
+#   3: seq u16, 14-bit checksum << 16
+
+from micropython import const
+from machine import mem32
+
+_SCRATCH0 = const(0x4005800C)
+_MAGIC = const(0x6A5)
+
+
+# Checksum of the first three words and seq, 14 bits
+def _checksum(w0, w1, w2, seq):
+    x = w0 ^ w1 ^ w2 ^ seq ^ 0x1A5A
+    return (x ^ x >> 14) & 0x3FFF
+
+
+def save(snap):
+    w0 = (snap.co & 0xFFFF) | (snap.batt & 0xFF) << 16
+    w1 = snap.ch4 & 0xFFFF
+    w2 = (snap.co2 & 0xFFFF) | _MAGIC << 16
+    seq = snap.seq & 0xFFFF
+    mem32[_SCRATCH0] = w0
+    mem32[_SCRATCH0 + 4] = w1
+    mem32[_SCRATCH0 + 8] = w2
+    mem32[_SCRATCH0 + 12] = seq | _checksum(w0, w1, w2, seq) << 16
+
+
+# (seq, co, ch4, co2, batt) saved before the reset, or None
+def load():
+    w0 = mem32[_SCRATCH0] & 0xFFFFFFFF
+    w1 = mem32[_SCRATCH0 + 4] & 0xFFFFFFFF
+    w2 = mem32[_SCRATCH0 + 8] & 0xFFFFFFFF
+    w3 = mem32[_SCRATCH0 + 12] & 0xFFFFFFFF
+    seq = w3 & 0xFFFF
+    if w2 >> 16 != _MAGIC or w3 >> 16 != _checksum(w0, w1, w2, seq):
+        return None
+    return seq, w0 & 0xFFFF, w1 & 0xFFFF, w2 & 0xFFFF, w0 >> 16 & 0xFF
+
+
+def clear():
+    mem32[_SCRATCH0 + 8] = 0
@@ -0,0 +1,126 @@
+# Fixed-size ring buffer with O(1) windowed statistics.
+#
+# Values live in a preallocated array. The running sum and sum of squares are
+# updated as values enter and leave the window, and min/max are tracked with
+# monotonic queues of slot indices, so every statistic costs the same no
+# matter how long the window is and pushing never allocates.
+
+from array import array
+
+
+class RingBuffer:
+    # typecode is an array typecode: "i" for integers, "f" for floats
+    def __init__(self, size, typecode="i"):
+        self._buf = array(typecode, [0] * size)
+        self._size = size
+        self._float = typecode in "fd"
+        self._idx = 0
+        self._count = 0
+        self._sum = 0
+        self._sumsq = 0
+        # Float sums drift as values are added and removed, so they are
+        # recomputed from the buffer once per window
+        self._since_resync = 0
+        # Monotonic queues (ring arrays of slot indices) for min and max
+        self._minq = array("H", [0] * size)
+        self._maxq = array("H", [0] * size)
+        self._min_head = 0
+        self._min_len = 0
+        self._max_head = 0
+        self._max_len = 0
+
+    def __len__(self):
+        return self._count
+
+    def full(self):
+        return self._count == self._size
+
+    def clear(self):
+        self._idx = 0
+        self._count = 0
+        self._sum = 0
+        self._sumsq = 0
+        self._since_resync = 0
+        self._min_len = 0
+        self._max_len = 0
+
+    def push(self, value):
+        buf = self._buf
+        idx = self._idx
+        size = self._size
+
+        if self._count == size:
+            old = buf[idx]
+            self._sum -= old
+            self._sumsq -= old * old
+            # The evicted value is the oldest, so it can only be at the
+            # front of either queue
+            if self._min_len and self._minq[self._min_head] == idx:
+                self._min_head = (self._min_head + 1) % size
+                self._min_len -= 1
+            if self._max_len and self._maxq[self._max_head] == idx:
+                self._max_head = (self._max_head + 1) % size
+                self._max_len -= 1
+        else:
+            self._count += 1
+
+        buf[idx] = value
+        # Read back so the sums match what the array actually stores
+        value = buf[idx]
+        self._sum += value
+        self._sumsq += value * value
+
+        # Drop queued values that can no longer be the min/max
+        q = self._minq
+        while self._min_len and buf[q[(self._min_head + self._min_len - 1) % size]] >= value:
+            self._min_len -= 1
+        q[(self._min_head + self._min_len) % size] = idx
+        self._min_len += 1
+
+        q = self._maxq
+        while self._max_len and buf[q[(self._max_head + self._max_len - 1) % size]] <= value:
+            self._max_len -= 1
+        q[(self._max_head + self._max_len) % size] = idx
+        self._max_len += 1
+
+        self._idx = (idx + 1) % size
+
+        if self._float:
+            self._since_resync += 1
+            if self._since_resync >= size:
+                self._resync()
+
+    def _resync(self):
+        total = 0.0
+        totalsq = 0.0
+        buf = self._buf
+        for i in range(self._count):
+            total += buf[i]
+            totalsq += buf[i] * buf[i]
+        self._sum = total
+        self._sumsq = totalsq
+        self._since_resync = 0
+
+    def sum(self):
+        return self._sum
+
+    def mean(self):
+        return self._sum / self._count if self._count else 0
+
+    def min(self):
+        return self._buf[self._minq[self._min_head]] if self._count else 0
+
+    def max(self):
+        return self._buf[self._maxq[self._max_head]] if self._count else 0
+
+    # Population variance of the values in the window
+    def variance(self):
+        n = self._count
+        if n < 2:
+            return 0
+        var = (self._sumsq - self._sum * self._sum / n) / n
+        return var if var > 0 else 0
+
+    # Most recently pushed value
+    def last(self):
+        return self._buf[(self._idx - 1) % self._size] if self._count else 0
@@ -0,0 +1,84 @@
+# Single sampling engine for the gas sensors and battery.
+#
+# One coroutine acquires every channel at a fixed rate and publishes a
+# Snapshot. Consumers (LCD, BLE, logging) wait for the next snapshot instead
+# of reading the ADCs themselves, so the cost per sample does not depend on
+# how many consumers are attached and they all see values from the same
+# instant.
+#
+# There is a single Snapshot, filled in place, so sampling allocates
+# nothing. Consumers read its fields before they next await: by then the
+# next sample may have overwritten them.
+
+import time
+import uasyncio as asyncio
+
+
+class Snapshot:
+    # seq: sample counter (wraps at 16 bits), ticks_ms: time.ticks_ms() at
+    # acquisition, co/ch4/co2: ppm, batt: battery percent
+    def __init__(self):
+        self.seq = 0
+        self.ticks_ms = 0
+        self.co = 0
+        self.ch4 = 0
+        self.co2 = 0
+        self.batt = 0
+
+
+class Sampler:
+    # acquire(snap) sets snap.co, ch4, co2 and batt for one sample
+    def __init__(self, acquire, period_ms=500):
+        self._acquire = acquire
+        self.period_ms = period_ms
+        # None until the first sample (or restore())
+        self.latest = None
+        self._snap = Snapshot()
+        # When the next sample is due (time.ticks_ms())
+        self.deadline = time.ticks_ms()
+        self._seq = 0
+        self._event = asyncio.Event()
+
+    # Publish readings carried over from before a reset, so consumers have
+    # something to show until the first new sample
+    def restore(self, seq, co, ch4, co2, batt):
+        snap = self._snap
+        snap.co = co
+        snap.ch4 = ch4
+        snap.co2 = co2
+        snap.batt = batt
+        snap.seq = self._seq = seq
+        snap.ticks_ms = time.ticks_ms()
+        self.latest = snap
+
+    # Take one sample and wake every waiting consumer
+    def sample(self):
+        snap = self._snap
+        self._acquire(snap)
+        self._seq = (self._seq + 1) & 0xFFFF
+        snap.seq = self._seq
+        snap.ticks_ms = time.ticks_ms()
+        self.latest = snap
+        self._event.set()
+        self._event.clear()
+        return self.latest
+
+    # Wait for a snapshot newer than the one with sequence number seq (pass
+    # -1 for whatever is available). Returns immediately if one has already
+    # been published, so a slow consumer skips to the latest sample.
+    async def next(self, seq=-1):
+        while self.latest is None or self.latest.seq == seq:
+            await self._event.wait()
+        return self.latest
+
+    async def run(self):
+        self.deadline = time.ticks_ms()
+        while True:
+            self.sample()
+            self.deadline = time.ticks_add(self.deadline, self.period_ms)
+            delay = time.ticks_diff(self.deadline, time.ticks_ms())
+            if delay < 0:
+                # Fell behind, start a new schedule rather than bursting
+                self.deadline = time.ticks_ms()
+                delay = 0
+            await asyncio.sleep_ms(delay)
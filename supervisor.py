@@ -0,0 +1,98 @@
+# Per-task supervision with a hardware watchdog.
+#
+# Each task runs inside a guard that restarts only that task, with
+# exponential backoff, when it raises or returns. The machine.WDT is fed only
+# while every critical task has reported progress within its deadline, so a
+# wedged task (or a blocked event loop) still ends in a hardware reset, but a
+# transient fault such as an I2C NACK costs milliseconds instead of a reboot.
+
+from micropython import const
+import time
+import uasyncio as asyncio
+from machine import WDT
+
+# Longest timeout the RP2040 watchdog supports is ~8.3 s
+_WDT_TIMEOUT_MS = const(8000)
+_WDT_FEED_MS = const(1000)
+# Longest the event loop may be blocked (e.g. in lightsleep) without the
+# watchdog firing: a feed period can pass on either side of the block, and
+# a second is left for the critical tasks to report progress again
+MAX_BLOCK_MS = const(_WDT_TIMEOUT_MS - 2 * _WDT_FEED_MS - 1000)
+# Restart backoff
+_BACKOFF_MIN_MS = const(10)
+_BACKOFF_MAX_MS = const(5000)
+# A task that ran this long before failing starts again from the minimum
+# backoff
+_BACKOFF_RESET_MS = const(30_000)
+
+
+class _Task:
+    def __init__(self, factory, critical, deadline_ms):
+        self.factory = factory
+        self.critical = critical
+        self.deadline_ms = deadline_ms
+        self.progress_ms = time.ticks_ms()
+        self.restarts = 0
+
+
+class Supervisor:
+    def __init__(self, log=print, watchdog=True):
+        self._tasks = {}
+        self._log = log
+        self._watchdog = watchdog
+
+    # factory() returns a new coroutine for the task each time it is
+    # (re)started. A critical task must call progress(name) at least every
+    # deadline_ms or the watchdog is no longer fed.
+    def add(self, name, factory, critical=False, deadline_ms=5000):
+        self._tasks[name] = _Task(factory, critical, deadline_ms)
+
+    def progress(self, name):
+        self._tasks[name].progress_ms = time.ticks_ms()
+
+    def restarts(self, name):
+        return self._tasks[name].restarts
+
+    def total_restarts(self):
+        return sum(task.restarts for task in self._tasks.values())
+
+    async def _guard(self, name, task):
+        backoff = _BACKOFF_MIN_MS
+        while True:
+            started = time.ticks_ms()
+            try:
+                await task.factory()
+                self._log("Task", name, "exited, restarting")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self._log("Task", name, "failed:", repr(e))
+
+            task.restarts += 1
+            if time.ticks_diff(time.ticks_ms(), started) > _BACKOFF_RESET_MS:
+                backoff = _BACKOFF_MIN_MS
+            await asyncio.sleep_ms(backoff)
+            backoff = min(backoff * 2, _BACKOFF_MAX_MS)
+
+    def healthy(self):
+        now = time.ticks_ms()
+        for task in self._tasks.values():
+            if task.critical and time.ticks_diff(now, task.progress_ms) > task.deadline_ms:
+                return False
+        return True
+
+    async def _feed(self):
+        wdt = WDT(timeout=_WDT_TIMEOUT_MS)
+        while True:
+            if self.healthy():
+                wdt.feed()
+            await asyncio.sleep_ms(_WDT_FEED_MS)
+
+    async def run(self):
+        tasks = [
+            asyncio.create_task(self._guard(name, task))
+            for name, task in self._tasks.items()
+        ]
+        if self._watchdog:
+            tasks.append(asyncio.create_task(self._feed()))
+        await asyncio.gather(*tasks)
@@ -5,6 +5,7 @@ import uasyncio as asyncio
 import RGB1602
 import math
 import network
+from ringbuf import RingBuffer
 
 # Parameters derived from calibration data
 # -----------------------------------------
@@ -43,23 +44,14 @@ def _blinkLED(led, seconds):
         led.value(0)
         time.sleep_ms(50)
 
-def mean(values):
-    return sum(values) / len(values) if values else 0
-
 # Write to LCD and set backlight
 def write_to_LCD(line1: str, line2: str, backlight: str = "normal"):
     # Truncate strings to 16 characters - LCD is 16x2
     line1 = line1[:16]
     line2 = line2[:16]
 
-    # Clear LCD
-    LCD.clear()
-
-    # Write both lines to LCD
-    LCD.setCursor(0, 0)
-    LCD.printout(line1)
-    LCD.setCursor(0, 1)
-    LCD.printout(line2)
+    # Write both lines to LCD, only the cells that changed are sent
+    LCD.update(line1, line2)
 
     # Set backlight
     if (backlight == "normal"):
@@ -99,10 +91,10 @@ def gas_ppm(Rs, Ro, MQ_m, MQ_b):
 
 # prints average of the last n values of the gas sensors
 def print_average(n : int):
-    # Initialize lists to store the last 5 values for a, b, c
-    a_values = []
-    b_values = []
-    c_values = []
+    # Ring buffers holding the last n values for a, b, c
+    a_values = RingBuffer(n, "f")
+    b_values = RingBuffer(n, "f")
+    c_values = RingBuffer(n, "f")
 
     while True:
         a = read_gas_sensor(MQ_4)
@@ -110,22 +102,15 @@ def print_average(n : int):
         c = read_gas_sensor(MQ_135)
         time.sleep_ms(200)
 
-        # Update the value lists (keeping only the last n values)
-        if len(a_values) >= n:
-            a_values.pop(0)
-        if len(b_values) >= n:
-            b_values.pop(0)
-        if len(c_values) >= n:
-            c_values.pop(0)
-
-        a_values.append(a)
-        b_values.append(b)
-        c_values.append(c)
-
-        if len(a_values) == n:
-            a_avg = mean(a_values)
-            b_avg = mean(b_values)
-            c_avg = mean(c_values)
+        # Update the windows (the oldest value drops out once full)
+        a_values.push(a)
+        b_values.push(b)
+        c_values.push(c)
+
+        if a_values.full():
+            a_avg = a_values.mean()
+            b_avg = b_values.mean()
+            c_avg = c_values.mean()
 
             # Print the averages
             print(f"MQ-4: {a_avg}")
@@ -0,0 +1,50 @@
+# Text formatting into preallocated buffers.
+#
+# f-strings and str() build new objects on every call. These helpers write
+# ASCII straight into a caller-owned bytearray instead, so a display line can
+# be refreshed forever without touching the heap. Each one writes from pos
+# up to (not including) end, drops whatever does not fit, and returns the
+# position after the last byte written.
+
+
+# Copy the bytes of text (a bytes literal)
+def put_bytes(buf, pos, end, text):
+    for i in range(len(text)):
+        if pos >= end:
+            break
+        buf[pos] = text[i]
+        pos += 1
+    return pos
+
+
+# Write the decimal digits of an integer
+def put_int(buf, pos, end, n):
+    if n < 0:
+        if pos >= end:
+            return pos
+        buf[pos] = 0x2D  # "-"
+        pos += 1
+        n = -n
+    digits = 1
+    scale = 10
+    while n >= scale:
+        digits += 1
+        scale *= 10
+    # The most significant digits go first, so a number that does not fit
+    # is cut on the right like a sliced string
+    scale //= 10
+    for _ in range(digits):
+        if pos >= end:
+            break
+        buf[pos] = 0x30 + n // scale % 10
+        pos += 1
+        scale //= 10
+    return pos
+
+
+# Fill the rest of the field with spaces
+def pad(buf, pos, end, fill=0x20):
+    while pos < end:
+        buf[pos] = fill
+        pos += 1
+    return pos